@@ -13,14 +13,22 @@ from skfuzzy import control as ctrl
 # --- Configuration ---
 CREDIT_PROFILE_TABLE = os.environ.get('CREDIT_PROFILE_TABLE')
 CREDIT_LIMIT_TABLE = os.environ.get('CREDIT_LIMIT_TABLE')
+SCORE_UPDATE_TOPIC_ARN = os.environ.get('SCORE_UPDATE_TOPIC_ARN')
 CONFIDENCE_SCORE = float(os.environ.get('CONFIDENCE_SCORE', '0.8')) # Admin-configurable parameter
 MODEL_VERSION = "v1.0.0"
 MINIMUM_CREDIT_LIMIT = 50
 MAXIMUM_CREDIT_LIMIT = 1000
+SNS_PUBLISH_BATCH_SIZE = 10 # SNS PublishBatch accepts at most 10 entries per call
+CONSOLIDATED_WINDOW = os.environ.get('CONSOLIDATED_WINDOW', '6m') # consolidatedMetrics window scored instead of the latest statement
+# Profile attributes the engine needs. statementMetrics is only read for
+# profiles written before statementSummary existed.
+PROFILE_ATTRIBUTES = ['userId', 'kycAnswers', 'statementSummary', 'consolidatedMetrics']
+LEGACY_PROFILE_ATTRIBUTES = ['statementMetrics']
 
 # --- AWS Client Initialization ---
 dynamodb_resource = boto3.resource('dynamodb')
 credit_limit_table = dynamodb_resource.Table(CREDIT_LIMIT_TABLE)
+sns_client = boto3.client('sns')
 
 
 # --- Fuzzy Logic System Definition (as provided) ---
@@ -80,14 +88,155 @@ def assess_risk(dti, volatility, min_balance, debt_honesty, character):
     return evaluator.output['RiskScore']
 
 # --- Helper Functions ---
-def deserialize_dynamodb_item(item):
-    """Converts a DynamoDB item (from a stream) into a regular Python dictionary."""
+def deserialize_dynamodb_item(item, attributes=None):
+    """
+    Converts a DynamoDB item (from a stream) into a regular Python dictionary.
+    When attributes is given, only those top-level attributes are deserialized.
+    """
     if not item:
         return {}
     
     deserializer = boto3.dynamodb.types.TypeDeserializer()
+    if attributes is not None:
+        return {k: deserializer.deserialize(item[k]) for k in attributes if k in item}
     return {k: deserializer.deserialize(v) for k, v in item.items()}
 
+def to_json_number(value):
+    """Converts a DynamoDB Decimal into an int or float so it can be JSON encoded."""
+    if value is None:
+        return None
+    if isinstance(value, Decimal):
+        return int(value) if value % 1 == 0 else float(value)
+    return value
+
+# --- Score Update Notifications ---
+
+class SnsScoreUpdatePublisher:
+    """Publishes batches of score update messages to the configured SNS topic."""
+
+    def __init__(self, topic_arn, client=None):
+        self.topic_arn = topic_arn
+        self.client = client or sns_client
+
+    def publish_batch(self, entries):
+        """Sends up to 10 entries with one PublishBatch call and returns the failed entries."""
+        response = self.client.publish_batch(
+            TopicArn=self.topic_arn,
+            PublishBatchRequestEntries=entries
+        )
+        return response.get('Failed', [])
+
+
+class InMemoryScoreUpdatePublisher:
+    """Local stand-in for SnsScoreUpdatePublisher that keeps every batch in memory."""
+
+    def __init__(self):
+        self.batches = []
+
+    @property
+    def messages(self):
+        return [json.loads(entry['Message']) for batch in self.batches for entry in batch]
+
+    def publish_batch(self, entries):
+        self.batches.append(list(entries))
+        return []
+
+
+class ScoreUpdateNotifier:
+    """
+    Buffers limit-changed events and publishes them in batches of up to
+    SNS_PUBLISH_BATCH_SIZE messages instead of one request per user.
+    """
+
+    def __init__(self, publisher):
+        self.publisher = publisher
+        self.pending = []
+
+    def add(self, user_id, old_limit, new_limit, model_version=MODEL_VERSION):
+        """Queues a limit-changed event. Unchanged limits are not published."""
+        if old_limit is not None and old_limit == new_limit:
+            return False
+
+        event = {
+            'eventType': 'CreditLimitChanged',
+            'userId': user_id,
+            'oldLimit': old_limit,
+            'newLimit': new_limit,
+            'modelVersion': model_version,
+            'publishedAt': datetime.utcnow().isoformat()
+        }
+        self.pending.append({
+            'Id': str(len(self.pending)),
+            'Message': json.dumps(event),
+            'MessageAttributes': {
+                'eventType': {'DataType': 'String', 'StringValue': event['eventType']}
+            }
+        })
+        if len(self.pending) >= SNS_PUBLISH_BATCH_SIZE:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Publishes all buffered events. Returns the number of events that failed."""
+        failed_count = 0
+        while self.pending:
+            batch = self.pending[:SNS_PUBLISH_BATCH_SIZE]
+            self.pending = self.pending[SNS_PUBLISH_BATCH_SIZE:]
+            try:
+                failed = self.publisher.publish_batch(batch)
+            except Exception as e:
+                print(f"ERROR publishing score update batch of {len(batch)} messages: {e}")
+                failed_count += len(batch)
+                continue
+            for failure in failed:
+                print(f"ERROR publishing score update message {failure.get('Id')}: {failure.get('Code')} {failure.get('Message')}")
+            failed_count += len(failed)
+        return failed_count
+
+
+def build_score_update_notifier():
+    """Returns a notifier bound to the SNS topic, or to an in-memory publisher when no topic is configured."""
+    if SCORE_UPDATE_TOPIC_ARN:
+        return ScoreUpdateNotifier(SnsScoreUpdatePublisher(SCORE_UPDATE_TOPIC_ARN))
+    print("Warning: SCORE_UPDATE_TOPIC_ARN is not set. Score updates will only be kept in memory.")
+    return ScoreUpdateNotifier(InMemoryScoreUpdatePublisher())
+
+def get_statement_list(statement_metrics):
+    """
+    Returns the per-statement metrics of profiles written before statementSummary
+    existed, from their legacy statementMetrics.perStatement list. Newer statements
+    are stored in their own table and reach the engine through statementSummary.
+    """
+    return list(statement_metrics.get('perStatement', []))
+
+def get_latest_statement(profile):
+    """
+    Returns the metrics of the most recently analyzed statement. The analyzer keeps
+    them in statementSummary.latest; older profiles fall back to sorting the list.
+    """
+    summary = profile.get('statementSummary') or {}
+    if summary.get('latest'):
+        return summary['latest']
+
+    per_statement_list = get_statement_list(profile.get('statementMetrics', {}))
+    if not per_statement_list:
+        return None
+    return max(per_statement_list, key=lambda x: x['analysisDate'])
+
+def get_scoring_metrics(profile):
+    """
+    Returns the metrics to score. When the user has statements from two or more
+    sources (e.g. bank and MoMo), the consolidated view is used, since transfers
+    between their own accounts inflate each statement's income and spending.
+    Otherwise the latest statement is scored.
+    """
+    consolidated = profile.get('consolidatedMetrics') or {}
+    window = consolidated.get('windows', {}).get(CONSOLIDATED_WINDOW)
+    if len(consolidated.get('sources', [])) >= 2 and window:
+        print(f"Scoring consolidated {CONSOLIDATED_WINDOW} metrics across {consolidated['sources']}")
+        return window
+    return get_latest_statement(profile)
+
 # --- KYC Scoring Logic ---
 
 def calculate_kyc_scores(kyc_answers):
@@ -132,14 +281,11 @@ def calculate_initial_limit(profile):
 
     # 1. Gather Data from the profile object
     kyc_answers = profile.get('kycAnswers', {})
-    statement_metrics = profile.get('statementMetrics', {})
-    per_statement_list = statement_metrics.get('perStatement', [])
+    latest_statement = get_scoring_metrics(profile)
 
-    if not per_statement_list:
+    if not latest_statement:
         raise ValueError("No statement analysis found in profile. Cannot calculate limit.")
         
-    latest_statement = sorted(per_statement_list, key=lambda x: x['analysisDate'], reverse=True)[0]
-        
     # 2. Normalize Data for Fuzzy Logic
     kyc_scores = calculate_kyc_scores(kyc_answers)
     debt_honesty = 1 + (kyc_scores['capacity_score'] / 15) * 4
@@ -187,9 +333,11 @@ def calculate_initial_limit(profile):
             'scoreLastCalculatedAt': datetime.utcnow().isoformat(),
             'modelVersion': MODEL_VERSION
         }
-        credit_limit_table.put_item(Item=item_to_save)
+        # ALL_OLD returns the replaced item, so the previous limit costs no extra read
+        response = credit_limit_table.put_item(Item=item_to_save, ReturnValues='ALL_OLD')
+        previous_limit = to_json_number(response.get('Attributes', {}).get('creditLimit'))
         print(f"Successfully saved credit limit for user {user_id}.")
-        return {"status": "success", "userId": user_id, "creditLimit": final_limit}
+        return {"status": "success", "userId": user_id, "creditLimit": final_limit, "previousLimit": previous_limit}
     except Exception as e:
         print(f"ERROR saving credit limit for user {user_id}: {e}")
         return {"status": "error", "message": str(e)}
@@ -201,7 +349,9 @@ def lambda_handler(event, context):
     AWS Lambda handler function triggered by a DynamoDB Stream from CreditProfileTable.
     """
     print(f"Received event: {json.dumps(event)}")
-    
+
+    notifier = build_score_update_notifier()
+
     for record in event.get('Records', []):
         try:
             if record.get('eventName') not in ['INSERT', 'MODIFY']:
@@ -214,8 +364,10 @@ def lambda_handler(event, context):
                 print("Skipping record with no NewImage.")
                 continue
             
-            # Convert the DynamoDB-formatted JSON into a standard Python dictionary
-            profile = deserialize_dynamodb_item(new_image)
+            # Convert only the attributes the engine uses into a standard Python dictionary
+            profile = deserialize_dynamodb_item(new_image, PROFILE_ATTRIBUTES)
+            if 'statementSummary' not in profile:
+                profile.update(deserialize_dynamodb_item(new_image, LEGACY_PROFILE_ATTRIBUTES))
             
             print(f"Processing record for userId: {profile.get('userId')}")
             
@@ -223,11 +375,17 @@ def lambda_handler(event, context):
             
             if result.get('status') == 'error':
                 print(f"Failed to calculate limit for {profile.get('userId')}. Reason: {result.get('message')}")
+            else:
+                notifier.add(result['userId'], result.get('previousLimit'), result['creditLimit'])
 
         except Exception as e:
             print(f"ERROR processing a record: {e}")
             continue
-            
+
+    failed_notifications = notifier.flush()
+    if failed_notifications:
+        print(f"Warning: {failed_notifications} score update notifications could not be published.")
+
     return {
         'statusCode': 200,
         'body': json.dumps({'status': 'success', 'message': 'Stream processing finished.'})
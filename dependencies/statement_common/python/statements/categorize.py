@@ -0,0 +1,144 @@
+from collections import deque
+from functools import lru_cache
+
+import numpy as np
+
+from statements.normalize import WORD_CHARACTERS
+
+# --- Categories ---
+# Category ids are stored in the columnar files, so only ever append to this list.
+CATEGORIES = [
+    'uncategorized',
+    'salary',
+    'transfer',
+    'ownTransfer',
+    'loanDisbursement',
+    'repayment',
+    'reversal',
+    'fees',
+]
+CATEGORY_IDS = {name: index for index, name in enumerate(CATEGORIES)}
+UNCATEGORIZED = CATEGORY_IDS['uncategorized']
+
+# Keywords are matched as whole words after uppercasing and replacing
+# punctuation with spaces, so short abbreviations such as 'SAL', 'FT', 'REV',
+# 'COMM' and 'VAT' never match inside longer words ("SALE", "GIFT", "REVENUE").
+# A trailing '*' matches any word starting with the keyword and is only allowed
+# on keywords of at least MIN_PREFIX_LENGTH characters.
+MIN_PREFIX_LENGTH = 5
+CATEGORY_KEYWORDS = {
+    'salary': ['SALARY', 'SALARIES', 'SAL', 'PAYROLL', 'WAGES', 'STIPEND', 'PENSION'],
+    'transfer': ['TRANSFER*', 'TRF', 'TRSF', 'TFR', 'FT', 'INTERBANK', 'GIP', 'ACH', 'MOMO'],
+    'ownTransfer': ['OWN ACCOUNT', 'OWN ACCT', 'TO SELF', 'FROM SELF', 'SELF TRANSFER', 'SWEEP',
+                    'BANK TO WALLET', 'WALLET TO BANK'],
+    'loanDisbursement': ['LOAN DISBURSEMENT', 'LOAN DISB*', 'DISBURSEMENT', 'LOAN PROCEEDS', 'LOAN DRAWDOWN',
+                         'QWIKLOAN', 'XPRESSLOAN'],
+    'repayment': ['REPAYMENT', 'LOAN REPAY*', 'LOAN RECOVERY', 'INSTALLMENT', 'INSTALMENT'],
+    'reversal': ['REVERSAL', 'REVERSED', 'REV', 'RVSL', 'REFUND', 'CHARGEBACK'],
+    'fees': ['FEE', 'FEES', 'CHARGE', 'CHARGES', 'COMMISSION', 'COMM', 'LEVY', 'E LEVY', 'ELEVY',
+             'SMS ALERT', 'MAINTENANCE', 'STAMP DUTY', 'VAT'],
+}
+
+# When several categories match, the first one in this order that fits the
+# transaction's direction wins (e.g. "REVERSAL OF SALARY" is a reversal).
+CATEGORY_PRIORITY = ['reversal', 'loanDisbursement', 'repayment', 'fees', 'ownTransfer', 'salary', 'transfer']
+INFLOW_ONLY = {'salary', 'loanDisbursement'}
+OUTFLOW_ONLY = {'repayment', 'fees'}
+
+# Inflows in these categories are not income, and outflows in these are not spending
+NOT_INCOME = [CATEGORY_IDS[name] for name in ('reversal', 'loanDisbursement', 'ownTransfer')]
+NOT_SPENDING = [CATEGORY_IDS['ownTransfer']]
+
+# --- Multi-Pattern Automaton ---
+
+class KeywordAutomaton:
+    """
+    An Aho-Corasick automaton over keyword -> category. One scan of a text reports
+    every category whose keywords occur in it, as a bitmask of category ids.
+    """
+
+    def __init__(self, keywords):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [0]
+        for keyword, category_id in keywords.items():
+            state = 0
+            for character in keyword:
+                if character not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(0)
+                    self.goto[state][character] = len(self.goto) - 1
+                state = self.goto[state][character]
+            self.output[state] |= 1 << category_id
+
+        # Breadth-first, so every fail target is finished before it is used
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and character not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(character, 0)
+                self.output[next_state] |= self.output[self.fail[next_state]]
+
+    def scan(self, text):
+        """Returns the bitmask of categories with a keyword in text."""
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        found = 0
+        for character in text:
+            while state and character not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(character, 0)
+            found |= output[state]
+        return found
+
+
+def build_keyword_automaton(category_keywords=CATEGORY_KEYWORDS):
+    """
+    Compiles the keyword dictionary, padding keywords with spaces for word
+    boundaries. Raises ValueError for a prefix keyword too short to be specific.
+    """
+    keywords = {}
+    for category, words in category_keywords.items():
+        for word in words:
+            if word.endswith('*') and len(word) - 1 < MIN_PREFIX_LENGTH:
+                raise ValueError(f"Prefix keyword {word!r} is shorter than {MIN_PREFIX_LENGTH} characters.")
+            pattern = ' ' + word[:-1] if word.endswith('*') else f' {word} '
+            keywords[pattern] = CATEGORY_IDS[category]
+    return KeywordAutomaton(keywords)
+
+
+AUTOMATON = build_keyword_automaton()
+
+# --- Categorization ---
+
+def resolve_category(found, is_inflow):
+    """Picks the highest-priority matched category that fits the direction."""
+    for name in CATEGORY_PRIORITY:
+        if not found & (1 << CATEGORY_IDS[name]):
+            continue
+        if (is_inflow and name in OUTFLOW_ONLY) or (not is_inflow and name in INFLOW_ONLY):
+            continue
+        return CATEGORY_IDS[name]
+    return UNCATEGORIZED
+
+@lru_cache(maxsize=8192)
+def categorize(description, is_inflow):
+    """
+    Returns the category id of a transaction description. Descriptions repeat a
+    lot within a statement, so results are cached and most rows skip the scan.
+    """
+    if not description:
+        return UNCATEGORIZED
+    text = f" {' '.join(description.upper().translate(WORD_CHARACTERS).split())} "
+    return resolve_category(AUTOMATON.scan(text), is_inflow)
+
+def flow_masks(inflow, category):
+    """Returns (income, spending) masks: inflows and outflows that count towards the metrics."""
+    income = inflow & ~np.isin(category, NOT_INCOME)
+    spending = ~inflow & ~np.isin(category, NOT_SPENDING)
+    return income, spending
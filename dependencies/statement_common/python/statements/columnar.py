@@ -0,0 +1,169 @@
+import json
+import posixpath
+import struct
+import tempfile
+from datetime import datetime
+
+import numpy as np
+
+from statements.transactions import TransactionChunk
+
+# --- Format ---
+# A columnar transaction file is a small header followed by row groups:
+#   magic (4 bytes) | schema version (uint16) | header length (uint32) | header JSON
+#   then per row group: row count (uint32) | each column's raw little-endian values
+# Bump SCHEMA_VERSION whenever COLUMNS or their meaning change; readers treat any
+# other version as stale, which forces a re-parse of the source CSV. Other files
+# in this format (the ledger) pass their own version to ColumnarWriter.
+MAGIC = b'FBTX'
+SCHEMA_VERSION = 4
+COLUMNS = [
+    ('day', np.dtype('<i8')),
+    ('amount', np.dtype('<f8')),
+    ('balance', np.dtype('<f8')),
+    ('inflow', np.dtype('|b1')),
+    ('counterparty', np.dtype('<i8')),
+    ('category', np.dtype('|i1')),
+    ('fee', np.dtype('<f8')),
+]
+PREAMBLE = struct.Struct('<4sHI')
+ROW_GROUP_HEADER = struct.Struct('<I')
+COLUMNAR_SUFFIX = '.txc'
+# The converter can write the columnar file itself (fused mode). It then stores a
+# generation token in the file's header and in this S3 metadata key of the CSV.
+GENERATION_METADATA = 'transactions-generation'
+SPOOL_MEMORY_SIZE = 8 * 1024 * 1024 # ChunkSpool bytes kept in memory before spilling to /tmp
+
+
+class ColumnarFormatError(ValueError):
+    """Raised when a columnar file is malformed or was written with another schema version."""
+
+
+def columnar_key_for(csv_key):
+    """Returns the key of the columnar file stored beside a processed CSV."""
+    return posixpath.splitext(csv_key)[0] + COLUMNAR_SUFFIX
+
+# --- Writing ---
+
+class ColumnarWriter:
+    """
+    Streams TransactionChunks into a file-like object as row groups. Other column
+    layouts (e.g. the ledger's) can be written by passing columns and their own
+    schema_version and calling write_columns with a dictionary of arrays.
+    """
+
+    def __init__(self, stream, metadata, columns=COLUMNS, schema_version=SCHEMA_VERSION):
+        self.stream = stream
+        self.columns = columns
+        self.row_count = 0
+        header = dict(metadata)
+        header['columns'] = [name for name, _ in columns]
+        header['createdAt'] = datetime.utcnow().isoformat()
+        header_bytes = json.dumps(header).encode('utf-8')
+        self.stream.write(PREAMBLE.pack(MAGIC, schema_version, len(header_bytes)))
+        self.stream.write(header_bytes)
+
+    def write_chunk(self, chunk):
+        self.write_columns({name: getattr(chunk, name) for name, _ in self.columns})
+
+    def write_columns(self, arrays):
+        row_count = len(arrays[self.columns[0][0]])
+        if not row_count:
+            return
+        self.stream.write(ROW_GROUP_HEADER.pack(row_count))
+        for name, dtype in self.columns:
+            self.stream.write(np.ascontiguousarray(arrays[name], dtype=dtype).tobytes())
+        self.row_count += row_count
+
+    def tee(self, chunks):
+        """Writes each chunk as it passes through, so the file is built during analysis."""
+        for chunk in chunks:
+            self.write_chunk(chunk)
+            yield chunk
+
+# --- Reading ---
+
+def read_exact(stream, size):
+    """Reads exactly size bytes, or returns b'' at a clean end of stream."""
+    data = stream.read(size)
+    while data and len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            break
+        data += more
+    if data and len(data) < size:
+        raise ColumnarFormatError("Columnar file is truncated.")
+    return data
+
+def read_columnar_header(stream, any_version=False):
+    """
+    Reads and validates the header. Returns the header metadata dictionary with the
+    file's schema version under 'schemaVersion'. Files from other schema versions
+    are rejected unless any_version is set (their rows still cannot be read).
+    """
+    preamble = read_exact(stream, PREAMBLE.size)
+    if not preamble:
+        raise ColumnarFormatError("Columnar file is empty.")
+    magic, version, header_length = PREAMBLE.unpack(preamble)
+    if magic != MAGIC:
+        raise ColumnarFormatError("Not a columnar transaction file.")
+    if version != SCHEMA_VERSION and not any_version:
+        raise ColumnarFormatError(f"Columnar schema version {version} does not match current version {SCHEMA_VERSION}.")
+    header = json.loads(read_exact(stream, header_length).decode('utf-8'))
+    header['schemaVersion'] = version
+    return header
+
+def iter_columnar_chunks(stream, columns=COLUMNS, factory=TransactionChunk):
+    """
+    Yields the row groups that follow the header, built with factory from the
+    column arrays (TransactionChunks by default; pass dict to get plain arrays).
+    """
+    while True:
+        group_header = read_exact(stream, ROW_GROUP_HEADER.size)
+        if not group_header:
+            return
+        (row_count,) = ROW_GROUP_HEADER.unpack(group_header)
+        arrays = {}
+        for name, dtype in columns:
+            raw = read_exact(stream, row_count * dtype.itemsize)
+            arrays[name] = np.frombuffer(raw, dtype=dtype).astype(dtype.newbyteorder('='))
+        yield factory(**arrays)
+
+# --- Spooling ---
+
+class ChunkSpool:
+    """
+    Keeps a statement's TransactionChunks in a temporary columnar file instead of a
+    list, so a later step (the ledger merge, and its retries) can replay them
+    without the whole statement staying in memory. Spills to /tmp past max_size.
+    """
+
+    def __init__(self, max_size=SPOOL_MEMORY_SIZE):
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=max_size)
+        self.writer = ColumnarWriter(self.buffer, {})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.writer.row_count
+
+    def append(self, chunk):
+        self.buffer.seek(0, 2)
+        self.writer.write_chunk(chunk)
+
+    def extend(self, chunks):
+        for chunk in chunks:
+            self.append(chunk)
+
+    def __iter__(self):
+        """Replays the chunks from the start. Only one replay can be in progress at a time."""
+        self.buffer.seek(0)
+        read_columnar_header(self.buffer)
+        return iter_columnar_chunks(self.buffer)
+
+    def close(self):
+        self.buffer.close()
@@ -0,0 +1,148 @@
+from collections import deque
+from datetime import datetime
+
+import numpy as np
+
+from statements.categorize import flow_masks
+from statements.ledger import month_label, to_cents
+from statements.transactions import month_numbers, summarize_months, to_decimal
+
+# --- Configuration ---
+TRANSFER_TOLERANCE_DAYS = 2 # Posting delay allowed between the two legs of an own-account transfer
+MIN_TRANSFER_CENTS = 1000 # Smaller equal amounts match by coincidence too often to be netted
+
+# --- Own-Account Transfer Matching ---
+
+def match_own_transfers(ledgers, tolerance_days=TRANSFER_TOLERANCE_DAYS):
+    """
+    Finds transfers between a user's own accounts: an outflow in one ledger and an
+    inflow of the same amount in another within tolerance_days. Candidates are
+    hash-joined on the amount in cents, and each bucket is walked in day order,
+    so the matching is linear in the number of candidates rather than quadratic.
+    Every row is matched at most once, to the earliest eligible counterpart.
+    Returns {source: boolean mask of the ledger rows that are own transfers}.
+    """
+    names = sorted(ledgers)
+    cents = {name: to_cents(ledgers[name].columns['amount']) for name in names}
+    masks = {name: np.zeros(len(ledgers[name]), dtype=bool) for name in names}
+
+    # Only amounts that occur as an outflow somewhere and an inflow somewhere else can match
+    outflow_cents = np.concatenate([cents[name][~ledgers[name].columns['inflow']] for name in names])
+    inflow_cents = np.concatenate([cents[name][ledgers[name].columns['inflow']] for name in names])
+    shared_cents = np.intersect1d(outflow_cents, inflow_cents)
+    shared_cents = shared_cents[shared_cents >= MIN_TRANSFER_CENTS]
+
+    inflows = [] # (day, source index, row)
+    outflows = []
+    for source, name in enumerate(names):
+        columns = ledgers[name].columns
+        candidates = np.flatnonzero(np.isin(cents[name], shared_cents))
+        for row in candidates.tolist():
+            target = inflows if columns['inflow'][row] else outflows
+            target.append((int(columns['day'][row]), source, row))
+
+    buckets = {}
+    for day, source, row in sorted(inflows):
+        buckets.setdefault(int(cents[names[source]][row]), deque()).append((day, source, row))
+
+    for day, source, row in sorted(outflows):
+        bucket = buckets.get(int(cents[names[source]][row]))
+        if not bucket:
+            continue
+        # Outflows arrive in day order, so inflows too old for this one are too old for all later ones
+        while bucket and bucket[0][0] < day - tolerance_days:
+            bucket.popleft()
+        for position, (in_day, in_source, in_row) in enumerate(bucket):
+            if in_day > day + tolerance_days:
+                break
+            if in_source != source:
+                masks[names[source]][row] = True
+                masks[names[in_source]][in_row] = True
+                del bucket[position]
+                break
+    return masks
+
+# --- Consolidated Metrics ---
+
+def monthly_flows(ledger, exclude, first_month, last_month):
+    """
+    Income, expenditure and lowest balance per month for one ledger, leaving out
+    the excluded rows from the flows. Months without rows carry the previous
+    closing balance, so the account still counts towards the combined balance.
+    """
+    columns = ledger.columns
+    months = month_numbers(columns['day'])
+    own_first = int(months[0])
+    month_count = max(last_month, int(months[-1])) - own_first + 1
+    index = months - own_first
+
+    counts_as_income, counts_as_spending = flow_masks(columns['inflow'], columns['category'])
+    income = np.bincount(index, weights=np.where(counts_as_income & ~exclude, columns['amount'], 0.0), minlength=month_count)
+    expenditure = np.bincount(index, weights=np.where(counts_as_spending & ~exclude, columns['amount'], 0.0), minlength=month_count)
+    lowest_balance = np.full(month_count, np.inf)
+    np.minimum.at(lowest_balance, index, columns['balance'])
+
+    # Rows are sorted by day, so the last row of each month holds its closing balance
+    last_row = np.full(month_count, -1)
+    np.maximum.at(last_row, index, np.arange(len(index)))
+    closing = np.nan
+    for month in range(month_count):
+        if last_row[month] >= 0:
+            closing = columns['balance'][last_row[month]]
+        elif not np.isnan(closing):
+            lowest_balance[month] = closing
+
+    window = slice(first_month - own_first, last_month - own_first + 1)
+    return income[window], expenditure[window], lowest_balance[window]
+
+def consolidated_metrics(ledgers, window_months):
+    """
+    Unified metrics across a user's ledgers (e.g. bank and MoMo) with own-account
+    transfers netted out. Covers only the months every source covers, so a month
+    is never missing one side of the picture. The combined lowest balance is the
+    sum of each account's monthly low, an approximation since the lows can fall on
+    different days. Returns None with fewer than two non-empty ledgers.
+    """
+    ledgers = {name: ledger for name, ledger in ledgers.items() if len(ledger)}
+    if len(ledgers) < 2:
+        return None
+
+    first_month = max(int(month_numbers(ledger.columns['day'][:1])[0]) for ledger in ledgers.values())
+    last_month = min(int(month_numbers(ledger.columns['day'][-1:])[0]) for ledger in ledgers.values())
+    transfers = match_own_transfers(ledgers)
+
+    transfer_count = sum(int(mask.sum()) for mask in transfers.values()) // 2
+    transfer_amount = sum(
+        float(ledger.columns['amount'][transfers[name] & ~ledger.columns['inflow']].sum())
+        for name, ledger in ledgers.items()
+    )
+    consolidated = {
+        'sources': sorted(ledgers),
+        'ownTransferCount': transfer_count,
+        'ownTransferAmount': to_decimal(transfer_amount),
+        'windows': {},
+        # Ledger versions only grow, so their sum orders consolidations of the same sources
+        'version': sum(ledger.version for ledger in ledgers.values()),
+        'updatedAt': datetime.utcnow().isoformat(),
+    }
+    if first_month > last_month:
+        print("Statement sources do not share any months; skipping consolidated windows.")
+        return consolidated
+
+    month_count = last_month - first_month + 1
+    income = np.zeros(month_count)
+    expenditure = np.zeros(month_count)
+    lowest_balance = np.zeros(month_count)
+    for name, ledger in ledgers.items():
+        source_income, source_expenditure, source_lowest = monthly_flows(ledger, transfers[name], first_month, last_month)
+        income += source_income
+        expenditure += source_expenditure
+        lowest_balance += source_lowest
+
+    for months in window_months:
+        consolidated['windows'][f"{months}m"] = summarize_months(
+            income[-months:], expenditure[-months:], lowest_balance[-months:]
+        )
+    consolidated['periodStart'] = month_label(first_month)
+    consolidated['periodEnd'] = month_label(last_month)
+    return consolidated
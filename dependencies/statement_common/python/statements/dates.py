@@ -0,0 +1,143 @@
+import re
+from datetime import datetime
+
+from statements.transactions import day_number
+
+# --- Configuration ---
+DATE_SAMPLE_SIZE = 50 # Data rows inspected to detect a statement's date format
+DATE_CACHE_LIMIT = 4096 # Distinct date strings memoized per column
+
+MONTH_NUMBERS = {
+    'JAN': 1, 'FEB': 2, 'MAR': 3, 'APR': 4, 'MAY': 5, 'JUN': 6,
+    'JUL': 7, 'AUG': 8, 'SEP': 9, 'OCT': 10, 'NOV': 11, 'DEC': 12,
+}
+DAYS_IN_MONTH = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+# Each supported format pairs the strptime format with a precompiled pattern
+# that captures the day, month and year groups.
+BANK_DATE_FORMATS = [
+    ('%d/%m/%Y', re.compile(r'\s*(?P<d>\d{1,2})/(?P<m>\d{1,2})/(?P<y>\d{4})\s*$')),           # e.g., 21/07/2025
+    ('%d-%b-%Y', re.compile(r'\s*(?P<d>\d{1,2})-(?P<m>[A-Za-z]{3})-(?P<y>\d{4})\s*$')),       # e.g., 21-Jul-2025
+    ('%Y-%m-%d', re.compile(r'\s*(?P<y>\d{4})-(?P<m>\d{1,2})-(?P<d>\d{1,2})\s*$')),           # e.g., 2025-07-21
+    ('%d-%m-%Y', re.compile(r'\s*(?P<d>\d{1,2})-(?P<m>\d{1,2})-(?P<y>\d{4})\s*$')),           # e.g., 21-07-2025
+]
+
+MOMO_DATE_FORMATS = [
+    # e.g., 21-Jul-2025 10:15:30 AM or 21-Jul-2025-10:15:30 AM
+    ('%d-%b-%Y %I:%M:%S %p', re.compile(
+        r'\s*(?P<d>\d{2})-(?P<m>[A-Za-z]{3})-(?P<y>\d{4})[-\s]'
+        r'(0?[1-9]|1[0-2]):[0-5]\d:([0-5]\d|6[01])\s+[AaPp][Mm]\s*$'
+    )),
+]
+
+# --- Slow Path Parsers ---
+
+def parse_momo_date(date_string):
+    """Parses the specific date format from the MTN statement."""
+    if not date_string:
+        return None
+    try:
+        cleaned_date_string = re.sub(r'(\d{2}-\w{3}-\d{4})[-\s]', r'\1 ', date_string.strip())
+        return datetime.strptime(cleaned_date_string, '%d-%b-%Y %I:%M:%S %p')
+    except (ValueError, TypeError):
+        return None
+
+def parse_bank_date(date_string):
+    """Parses common date formats found in bank statements by trying multiple formats."""
+    if not isinstance(date_string, str) or not date_string.strip():
+        return None
+
+    for fmt, _ in BANK_DATE_FORMATS:
+        try:
+            return datetime.strptime(date_string.strip(), fmt)
+        except (ValueError, TypeError):
+            continue # Try the next format
+
+    # If all formats fail, return None
+    return None
+
+# --- Fast Path Parsing ---
+
+def civil_day_number(year, month, day):
+    """Converts a calendar date into a day number without building a datetime. Returns None if invalid."""
+    if not 1 <= month <= 12 or day < 1 or year < 1:
+        return None
+    leap = year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+    if day > DAYS_IN_MONTH[month - 1] + (1 if month == 2 and leap else 0):
+        return None
+
+    # Days-from-civil algorithm (proleptic Gregorian calendar, day 0 = 1970-01-01)
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+class DateColumnParser:
+    """
+    Parses one statement's date column into day numbers. Rows matching the detected
+    format are decoded with a precompiled pattern; anything else falls back to the
+    slow strptime-based parser.
+    """
+
+    def __init__(self, date_format, pattern, fallback, memoize=True):
+        self.date_format = date_format
+        self.pattern = pattern
+        self.fallback = fallback
+        self.memoize = memoize
+        self.cache = {}
+        self.fallback_count = 0
+
+    def _fast(self, value):
+        match = self.pattern.match(value)
+        if not match:
+            return None
+        month = match.group('m')
+        month = int(month) if month.isdigit() else MONTH_NUMBERS.get(month.upper(), 0)
+        return civil_day_number(int(match.group('y')), month, int(match.group('d')))
+
+    def _slow(self, value):
+        self.fallback_count += 1
+        date_obj = self.fallback(value)
+        return day_number(date_obj) if date_obj else None
+
+    def __call__(self, value):
+        if not value:
+            return None
+        if self.memoize and value in self.cache:
+            return self.cache[value]
+
+        day = self._fast(value) if self.pattern is not None else None
+        if day is None:
+            day = self._slow(value)
+
+        if self.memoize and len(self.cache) < DATE_CACHE_LIMIT:
+            self.cache[value] = day
+        return day
+
+
+def detect_date_parser(samples, formats, fallback, memoize=True):
+    """
+    Picks the format whose pattern matches most of the sample values (earlier
+    formats win ties) and returns a DateColumnParser specialized for it.
+    """
+    best_format, best_pattern, best_count = None, None, 0
+    for date_format, pattern in formats:
+        count = sum(1 for value in samples if value and pattern.match(value))
+        if count > best_count:
+            best_format, best_pattern, best_count = date_format, pattern, count
+
+    if best_format:
+        print(f"Detected date format '{best_format}' from {best_count} of {len(samples)} sampled rows.")
+    else:
+        print("Could not detect a date format from the sampled rows. Using the slow parser.")
+    return DateColumnParser(best_format, best_pattern, fallback, memoize=memoize)
+
+def detect_bank_date_parser(samples):
+    return detect_date_parser(samples, BANK_DATE_FORMATS, parse_bank_date)
+
+def detect_momo_date_parser(samples):
+    # MoMo timestamps are almost always distinct, so memoizing them would not pay off
+    return detect_date_parser(samples, MOMO_DATE_FORMATS, parse_momo_date, memoize=False)
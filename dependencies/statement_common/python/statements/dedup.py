@@ -0,0 +1,99 @@
+import hashlib
+from datetime import datetime
+
+from botocore.exceptions import ClientError
+
+# --- Configuration ---
+# S3 metadata key of a processed CSV holding the hash of the PDF it came from
+CONTENT_HASH_METADATA = 'content-hash'
+
+# --- Content-Addressed Statement Index ---
+#
+# One entry per distinct statement PDF a user uploaded, keyed by userId and the
+# SHA-256 of its bytes. Byte-identical uploads of two users stay separate, so one
+# user's conversion is never copied into another's statements:
+#   userId, contentHash, statementType, csvKey, generation, sourceKey, convertedAt
+# and, once the analyzer has run on that conversion:
+#   metrics, metricsGeneration
+# generation is the token the converter stamps on the CSV (GENERATION_METADATA),
+# so a copied CSV keeps it and anything derived from one conversion stays tied to it.
+
+def content_hash(data):
+    """SHA-256 hex digest of a statement's bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class DynamoDBStatementIndex:
+    """The statement index in a DynamoDB table with partition key userId and sort key contentHash."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def get(self, user_id, digest):
+        response = self.table.get_item(Key={'userId': user_id, 'contentHash': digest}, ConsistentRead=True)
+        return response.get('Item')
+
+    def record_conversion(self, user_id, digest, statement_type, csv_key, generation, source_key):
+        """Points the hash at a new conversion. Replaces the whole entry, dropping metrics of older ones."""
+        self.table.put_item(Item={
+            'userId': user_id,
+            'contentHash': digest,
+            'statementType': statement_type,
+            'csvKey': csv_key,
+            'generation': generation,
+            'sourceKey': source_key,
+            'convertedAt': datetime.utcnow().isoformat(),
+        })
+
+    def record_metrics(self, user_id, digest, generation, metrics):
+        """
+        Stores the metrics computed from a conversion. Skipped when the entry has
+        since moved on to another conversion. Returns True when stored.
+        """
+        try:
+            self.table.update_item(
+                Key={'userId': user_id, 'contentHash': digest},
+                UpdateExpression='SET #metrics = :metrics, #metrics_generation = :generation',
+                ConditionExpression='#generation = :generation',
+                ExpressionAttributeNames={
+                    '#metrics': 'metrics',
+                    '#metrics_generation': 'metricsGeneration',
+                    '#generation': 'generation',
+                },
+                ExpressionAttributeValues={':metrics': metrics, ':generation': generation}
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return False
+
+
+class InMemoryStatementIndex:
+    """Stand-in for DynamoDBStatementIndex that keeps entries in a dict, for tests and local runs."""
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, user_id, digest):
+        entry = self.entries.get((user_id, digest))
+        return dict(entry) if entry is not None else None
+
+    def record_conversion(self, user_id, digest, statement_type, csv_key, generation, source_key):
+        self.entries[(user_id, digest)] = {
+            'userId': user_id,
+            'contentHash': digest,
+            'statementType': statement_type,
+            'csvKey': csv_key,
+            'generation': generation,
+            'sourceKey': source_key,
+            'convertedAt': datetime.utcnow().isoformat(),
+        }
+
+    def record_metrics(self, user_id, digest, generation, metrics):
+        entry = self.entries.get((user_id, digest))
+        if entry is None or entry['generation'] != generation:
+            return False
+        entry['metrics'] = metrics
+        entry['metricsGeneration'] = generation
+        return True
@@ -0,0 +1,109 @@
+import math
+from decimal import Decimal
+
+import numpy as np
+
+from statements.ledger import row_hashes
+
+# --- Configuration ---
+BALANCE_TOLERANCE = 0.011 # A cent of rounding either way
+# The tamper score is 1 - exp(-weighted findings / TAMPER_SCALE). One edited
+# balance scores about 0.4 however long the statement is: a single hand-edited
+# balance is strong evidence, while an isolated gap may be an extraction miss.
+TAMPER_SCALE = 6.0
+TAMPER_WEIGHTS = {
+    'editedBalances': 3.0, # A balance changed by hand breaks continuity twice, in opposite directions
+    'sequenceGaps': 1.0, # Rows removed (or an amount changed) break it once
+    'duplicateRows': 1.0,
+    'dateRegressions': 0.5,
+}
+
+# --- Balance Continuity ---
+
+class ContinuityCounter:
+    """
+    Counts balance breaks for one assumed row order. Residuals arrive chunk by
+    chunk; the last residual is carried so pairs spanning two chunks are found.
+    """
+
+    def __init__(self):
+        self.breaks = 0
+        self.paired_breaks = 0
+        self.date_regressions = 0
+        self.last_residual = 0.0
+
+    def add(self, residual, date_regressed):
+        if not len(residual):
+            return
+        broken = np.abs(residual) > BALANCE_TOLERANCE
+        previous = np.concatenate(([self.last_residual], residual[:-1]))
+        # An edited balance shows up as +x on its own row and -x on the next one
+        paired = broken & (np.abs(previous) > BALANCE_TOLERANCE) & (np.abs(residual + previous) <= BALANCE_TOLERANCE)
+
+        self.breaks += int(broken.sum())
+        self.paired_breaks += int(paired.sum())
+        self.date_regressions += int(date_regressed.sum())
+        self.last_residual = float(residual[-1])
+
+
+class IntegrityChecker:
+    """
+    Checks a statement's rows for signs of editing as they stream past:
+    running-balance continuity (previous balance + credit - debit - fees = balance),
+    duplicate rows and dates going backwards. Statements can list rows oldest or
+    newest first, so both orders are checked and the one with fewer breaks is used.
+    Every check is a handful of array operations per chunk.
+    """
+
+    def __init__(self):
+        self.ascending = ContinuityCounter()
+        self.descending = ContinuityCounter()
+        self.row_count = 0
+        self.hashes = []
+        self.last_row = None # (balance, signed change, day) of the previous chunk's last row
+
+    def add(self, chunk):
+        if not len(chunk):
+            return
+        change = np.where(chunk.inflow, chunk.amount, -chunk.amount) - chunk.fee
+        balance, day = chunk.balance, chunk.day
+        if self.last_row is not None:
+            last_balance, last_change, last_day = self.last_row
+            balance = np.concatenate(([last_balance], balance))
+            change = np.concatenate(([last_change], change))
+            day = np.concatenate(([last_day], day))
+
+        balance_step = np.diff(balance)
+        day_step = np.diff(day)
+        # Oldest first: each row's balance moves by its own change.
+        # Newest first: each balance is the next row's balance plus the previous row's change.
+        self.ascending.add(balance_step - change[1:], day_step < 0)
+        self.descending.add(-balance_step - change[:-1], day_step > 0)
+
+        moved = chunk.amount > 0
+        self.hashes.append(row_hashes(chunk.day[moved], chunk.amount[moved], chunk.balance[moved],
+                                      chunk.inflow[moved], chunk.counterparty[moved]))
+        self.row_count += len(chunk)
+        self.last_row = (balance[-1], change[-1], day[-1])
+
+    def result(self):
+        """Returns the integrity summary stored with the statement metrics."""
+        if self.ascending.breaks <= self.descending.breaks:
+            row_order, counter = 'ascending', self.ascending
+        else:
+            row_order, counter = 'descending', self.descending
+
+        hashes = np.concatenate(self.hashes) if self.hashes else np.zeros(0, dtype=np.uint64)
+        findings = {
+            'editedBalances': counter.paired_breaks,
+            'sequenceGaps': max(counter.breaks - 2 * counter.paired_breaks, 0),
+            'duplicateRows': int(len(hashes) - len(np.unique(hashes))),
+            'dateRegressions': counter.date_regressions,
+        }
+        weighted = sum(TAMPER_WEIGHTS[name] * count for name, count in findings.items())
+        tamper_score = 1.0 - math.exp(-weighted / TAMPER_SCALE)
+
+        summary = {'rowsChecked': self.row_count, 'rowOrder': row_order, 'balanceBreaks': counter.breaks}
+        summary.update(findings)
+        summary['tamperScore'] = Decimal(str(round(tamper_score, 3)))
+        return summary
@@ -0,0 +1,295 @@
+from datetime import datetime
+
+import numpy as np
+
+from statements.columnar import (
+    COLUMNAR_SUFFIX,
+    ColumnarFormatError,
+    ColumnarWriter,
+    iter_columnar_chunks,
+    read_columnar_header,
+)
+from statements.categorize import flow_masks
+from statements.transactions import day_to_date, month_numbers, month_start_day, summarize_months
+
+# --- Configuration ---
+# A ledger is a columnar file with the transaction columns plus the transaction
+# hash. Rows are kept sorted by day so a month's rows are one contiguous slice.
+# The layout and its version are the ledger's own: a change to the columnar
+# cache's format must not discard every user's ledger. Bump LEDGER_SCHEMA_VERSION
+# whenever LEDGER_COLUMNS or their meaning change.
+LEDGER_SCHEMA_VERSION = 4 # Started at the cache's version the first ledgers were written with
+LEDGER_COLUMNS = [
+    ('day', np.dtype('<i8')),
+    ('amount', np.dtype('<f8')),
+    ('balance', np.dtype('<f8')),
+    ('inflow', np.dtype('|b1')),
+    ('counterparty', np.dtype('<i8')),
+    ('category', np.dtype('|i1')),
+    ('fee', np.dtype('<f8')),
+    ('hash', np.dtype('<u8')),
+]
+TRANSACTION_COLUMNS = [name for name, _ in LEDGER_COLUMNS if name != 'hash']
+HASHED_COLUMNS = ['day', 'amount', 'balance', 'inflow', 'counterparty'] # The arguments of TransactionHasher.hashes
+LEDGER_KIND = 'ledger'
+LEDGER_ROW_GROUP_SIZE = 65536
+HASH_SEED = np.uint64(0x6A09E667F3BCC908)
+
+
+def ledger_prefix_for(user_id):
+    """Returns the key prefix under which all of a user's ledgers are stored."""
+    return f"ledger/{user_id}/"
+
+def ledger_key_for(user_id, statement_type):
+    """Returns the key of a user's ledger for one statement type."""
+    return f"{ledger_prefix_for(user_id)}{statement_type}{COLUMNAR_SUFFIX}"
+
+# --- Transaction Hashing ---
+
+def splitmix64(values):
+    """Applies the SplitMix64 finalizer to a uint64 array, element-wise."""
+    with np.errstate(over='ignore'):
+        z = values + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+def to_cents(values):
+    return np.rint(np.asarray(values, dtype=np.float64) * 100).astype(np.int64)
+
+def row_hashes(day, amount, balance, inflow, counterparty):
+    """
+    Hashes each row from its day, amount and balance (in cents), direction and
+    counterparty. Identical rows get identical hashes.
+    """
+    hashes = splitmix64(np.asarray(day, dtype=np.int64).view(np.uint64) ^ HASH_SEED)
+    for column in (to_cents(amount), to_cents(balance), np.asarray(counterparty, dtype=np.int64),
+                   np.asarray(inflow, dtype=np.int64)):
+        hashes = splitmix64(hashes ^ column.view(np.uint64))
+    return hashes
+
+def occurrence_numbers(hashes):
+    """Numbers each hash by how often it already appeared earlier in the array (0 for the first)."""
+    order = np.argsort(hashes, kind='stable')
+    sorted_hashes = hashes[order]
+    first = np.ones(len(hashes), dtype=bool)
+    first[1:] = sorted_hashes[1:] != sorted_hashes[:-1]
+    positions = np.arange(len(hashes))
+    group_start = np.maximum.accumulate(np.where(first, positions, 0))
+    occurrence = np.empty(len(hashes), dtype=np.uint64)
+    occurrence[order] = (positions - group_start).astype(np.uint64)
+    return occurrence
+
+
+class TransactionHasher:
+    """
+    Row hashes made unique per statement. Identical rows within one statement are
+    real (two equal payments on the same day), so repeats are numbered and the
+    number is mixed in; the same statement uploaded twice produces the same hashes.
+    The category is derived from the description, so it is left out: a keyword
+    change must not make known transactions look new.
+
+    A statement can be hashed chunk by chunk: repeats are counted across chunk
+    boundaries, so the hashes match those of the whole statement at once.
+    """
+
+    def __init__(self):
+        # Sorted raw hashes seen in earlier chunks and how often each appeared
+        self.seen = np.zeros(0, dtype=np.uint64)
+        self.seen_counts = np.zeros(0, dtype=np.uint64)
+
+    def hashes(self, day, amount, balance, inflow, counterparty):
+        hashes = row_hashes(day, amount, balance, inflow, counterparty)
+        occurrence = occurrence_numbers(hashes)
+        if len(self.seen):
+            index = np.minimum(np.searchsorted(self.seen, hashes), len(self.seen) - 1)
+            known = self.seen[index] == hashes
+            occurrence[known] += self.seen_counts[index[known]]
+
+        unique, counts = np.unique(hashes, return_counts=True)
+        self.seen, inverse = np.unique(np.concatenate([self.seen, unique]), return_inverse=True)
+        seen_counts = np.zeros(len(self.seen), dtype=np.uint64)
+        np.add.at(seen_counts, inverse, np.concatenate([self.seen_counts, counts.astype(np.uint64)]))
+        self.seen_counts = seen_counts
+
+        repeated = occurrence > 0
+        hashes[repeated] = splitmix64(hashes[repeated] ^ occurrence[repeated])
+        return hashes
+
+
+def transaction_hashes(day, amount, balance, inflow, counterparty):
+    """The TransactionHasher hashes of a whole statement's columns."""
+    return TransactionHasher().hashes(day, amount, balance, inflow, counterparty)
+
+# --- Month Helpers ---
+
+def month_label(month):
+    return day_to_date(month_start_day(month)).strftime('%Y-%m')
+
+# --- Ledger ---
+
+class TransactionLedger:
+    """
+    A user's deduplicated transactions for one statement type, plus per-month
+    totals. Merging a statement only adds rows whose hash is not already present
+    and only recomputes the months those rows fall in.
+    """
+
+    def __init__(self, columns=None, header=None):
+        header = header or {}
+        self.columns = columns or {name: np.zeros(0, dtype=dtype) for name, dtype in LEDGER_COLUMNS}
+        self.sources = header.get('sources', {})
+        # month number -> [income, expenditure, lowest balance, row count]
+        self.months = {int(month): totals for month, totals in header.get('months', {}).items()}
+        self.duplicate_count = header.get('duplicateCount', 0)
+        self.version = header.get('version', 0)
+        self.stale = False
+        self._sorted_hashes = None
+
+    def __len__(self):
+        return len(self.columns['day'])
+
+    @classmethod
+    def read(cls, stream):
+        """
+        Loads a ledger written by write(). Raises ColumnarFormatError for other files.
+        A ledger from an older schema comes back empty and marked stale, keeping only
+        its version so versions keep increasing once it is rebuilt.
+        """
+        header = read_columnar_header(stream, any_version=True)
+        if header.get('kind') != LEDGER_KIND:
+            raise ColumnarFormatError("Columnar file is not a transaction ledger.")
+        if header['schemaVersion'] != LEDGER_SCHEMA_VERSION:
+            ledger = cls(header={'version': header.get('version', 0)})
+            ledger.stale = True
+            return ledger
+        groups = list(iter_columnar_chunks(stream, LEDGER_COLUMNS, dict))
+        columns = {
+            name: np.concatenate([group[name] for group in groups]) if groups else np.zeros(0, dtype=dtype)
+            for name, dtype in LEDGER_COLUMNS
+        }
+        return cls(columns, header)
+
+    def write(self, stream):
+        writer = ColumnarWriter(stream, {
+            'kind': LEDGER_KIND,
+            'version': self.version,
+            'sources': self.sources,
+            'months': {str(month): totals for month, totals in self.months.items()},
+            'duplicateCount': self.duplicate_count,
+        }, LEDGER_COLUMNS, LEDGER_SCHEMA_VERSION)
+        for start in range(0, len(self), LEDGER_ROW_GROUP_SIZE):
+            writer.write_columns({name: values[start:start + LEDGER_ROW_GROUP_SIZE] for name, values in self.columns.items()})
+
+    def contains(self, hashes):
+        """Boolean mask of the hashes already in the ledger, via a sorted hash index."""
+        if self._sorted_hashes is None:
+            self._sorted_hashes = np.sort(self.columns['hash'])
+        if not len(self._sorted_hashes):
+            return np.zeros(len(hashes), dtype=bool)
+        index = np.minimum(np.searchsorted(self._sorted_hashes, hashes), len(self._sorted_hashes) - 1)
+        return self._sorted_hashes[index] == hashes
+
+    def merge(self, chunks, source_id, source_token=None):
+        """
+        Adds a statement's TransactionChunks. Chunks are hashed and checked against
+        the ledger one at a time and only their new rows are kept, so the statement
+        is never held in memory as a whole. Returns a summary of the merge with the
+        number of new and duplicate transactions and the months that changed.
+        """
+        hasher = TransactionHasher()
+        new_parts = []
+        row_count = 0
+        for chunk in chunks:
+            if not len(chunk):
+                continue
+            incoming = {name: getattr(chunk, name) for name in TRANSACTION_COLUMNS}
+            incoming['hash'] = hasher.hashes(*(incoming[name] for name in HASHED_COLUMNS))
+            # Hashes are unique within a statement, so checking against the ledger as it
+            # was before this merge is enough
+            new_rows = ~self.contains(incoming['hash'])
+            if new_rows.any():
+                new_parts.append({name: values[new_rows] for name, values in incoming.items()})
+            row_count += len(chunk)
+
+        added = sum(len(part['day']) for part in new_parts)
+        duplicates = row_count - added
+        affected_months = []
+
+        if added:
+            new_columns = {name: np.concatenate([part[name] for part in new_parts]) for name, _ in LEDGER_COLUMNS}
+            order = np.argsort(new_columns['day'], kind='stable')
+            new_columns = {name: values[order] for name, values in new_columns.items()}
+            # Both sides are sorted by day, so the new rows can be inserted in place
+            positions = np.searchsorted(self.columns['day'], new_columns['day'], side='right')
+            self.columns = {name: np.insert(self.columns[name], positions, new_columns[name]) for name in self.columns}
+            self._sorted_hashes = None
+
+            affected_months = np.unique(month_numbers(new_columns['day'])).tolist()
+            self._refresh_months(affected_months)
+
+        self.sources[source_id] = {
+            'token': source_token,
+            'rows': row_count,
+            'added': added,
+            'mergedAt': datetime.utcnow().isoformat(),
+        }
+        self.duplicate_count += duplicates
+        self.version += 1
+        return {
+            'statementId': source_id,
+            'added': added,
+            'duplicates': duplicates,
+            'affectedMonths': [month_label(month) for month in affected_months],
+        }
+
+    def _refresh_months(self, months):
+        """Recomputes the totals of the given months from their slice of the ledger."""
+        days = self.columns['day']
+        for month in months:
+            start, end = np.searchsorted(days, [month_start_day(month), month_start_day(month + 1)])
+            if start == end:
+                self.months.pop(month, None)
+                continue
+            amount = self.columns['amount'][start:end]
+            income, spending = flow_masks(self.columns['inflow'][start:end], self.columns['category'][start:end])
+            self.months[month] = [
+                float(amount[income].sum()),
+                float(amount[spending].sum()),
+                float(self.columns['balance'][start:end].min()),
+                int(end - start),
+            ]
+
+    def monthly(self):
+        """Dense per-month income, expenditure and lowest balance arrays from the first to the latest month."""
+        first_month, latest_month = min(self.months), max(self.months)
+        month_count = latest_month - first_month + 1
+        income = np.zeros(month_count)
+        expenditure = np.zeros(month_count)
+        lowest_balance = np.full(month_count, np.inf)
+        for month, (month_income, month_expenditure, month_lowest, _) in self.months.items():
+            income[month - first_month] = month_income
+            expenditure[month - first_month] = month_expenditure
+            lowest_balance[month - first_month] = month_lowest
+        return income, expenditure, lowest_balance
+
+    def metrics(self, window_months):
+        """
+        Metrics over the ledger for trailing windows of calendar months, keyed like
+        '3m', plus ledger totals. Returns None for an empty ledger.
+        """
+        if not self.months:
+            return None
+        income, expenditure, lowest_balance = self.monthly()
+        windows = {}
+        for months in window_months:
+            windows[f"{months}m"] = summarize_months(income[-months:], expenditure[-months:], lowest_balance[-months:])
+        return {
+            'windows': windows,
+            'transactionCount': len(self),
+            'duplicateTransactions': self.duplicate_count,
+            'statementCount': len(self.sources),
+            'periodStart': day_to_date(self.columns['day'][0]).isoformat(),
+            'periodEnd': day_to_date(self.columns['day'][-1]).isoformat(),
+            'version': self.version,
+        }
@@ -0,0 +1,84 @@
+import hashlib
+import math
+from functools import lru_cache
+
+# --- Translation Tables ---
+
+class KeepCharacters(dict):
+    """
+    A str.translate table that keeps the given characters and deletes every other
+    one (or replaces it with replacement). Lookups are memoized, so after warm-up
+    each character costs a single dict hit.
+    """
+
+    def __init__(self, keep, replacement=None):
+        super().__init__()
+        self.keep = frozenset(map(ord, keep))
+        self.replacement = replacement
+
+    def __missing__(self, code):
+        value = code if code in self.keep else self.replacement
+        self[code] = value
+        return value
+
+
+DIGITS = KeepCharacters('0123456789')
+SIGNED_AMOUNT = KeepCharacters('0123456789.-()')
+WORD_CHARACTERS = KeepCharacters('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', ' ') # Applied after upper()
+
+# --- Field Normalization ---
+
+def parse_amount(value):
+    """
+    Converts an amount or balance cell to a float. Handles thousands separators,
+    currency text, leading or trailing minus signs, parenthesized debits and
+    DR suffixes. Returns 0.0 when nothing numeric can be read.
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, str):
+        return 0.0
+
+    # Fast path: most cells are already plain numbers
+    try:
+        number = float(value)
+        return number if math.isfinite(number) else 0.0
+    except ValueError:
+        pass
+
+    compact = value.translate(SIGNED_AMOUNT)
+    if not compact:
+        return 0.0
+
+    negative = (
+        compact[0] == '-'
+        or compact[-1] == '-'
+        or (compact[0] == '(' and compact[-1] == ')')
+        or value.rstrip().upper().endswith('DR')
+    )
+    try:
+        number = float(compact.strip('-()'))
+    except ValueError:
+        return 0.0
+    return -number if negative else number
+
+def digits_only(value):
+    """Strips everything but digits, e.g. from a phone number cell."""
+    if not isinstance(value, str):
+        return ''
+    return value.translate(DIGITS)
+
+@lru_cache(maxsize=4096)
+def counterparty_id(value):
+    """
+    Maps a counterparty (a description or phone number) to a stable signed 64-bit id.
+    Case and whitespace are ignored and empty values map to 0. Unlike hash(), the
+    id is the same in every process, so it can be stored and compared across runs.
+    """
+    if not isinstance(value, str):
+        return 0
+    normalized = ' '.join(value.upper().split())
+    if not normalized:
+        return 0
+    digest = hashlib.blake2b(normalized.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
@@ -0,0 +1,186 @@
+from itertools import chain, islice
+
+from statements.transactions import TransactionChunkBuilder
+from statements.dates import DATE_SAMPLE_SIZE, detect_bank_date_parser, detect_momo_date_parser
+from statements.normalize import counterparty_id, digits_only, parse_amount
+from statements.categorize import categorize
+
+# --- Row Helpers ---
+
+def cell(row, index):
+    """Returns the cell at index, or None when the row is shorter than the header."""
+    if index is None or index >= len(row):
+        return None
+    return row[index]
+
+# --- Provider-Specific Parsing ---
+
+def iter_bank_statement_chunks(rows, user_id):
+    """
+    Parses the rows of a bank statement's tables into TransactionChunks in a single
+    streaming pass. rows is any iterable of cell lists, e.g. a csv.reader over the
+    processed CSV or the converter's extracted table rows.
+    """
+    print(f"Running analysis for Bank Statement rows for user: {user_id}")
+
+    reader = iter(rows)
+
+    # --- Step 1: Find Header ---
+    header = None
+    header_keywords = ["DATE", "DESCRIPTION", "DEBIT", "CREDIT", "BALANCE"]
+    for row in reader:
+        # Check if the current row is the header by looking for keywords
+        row_text = ' '.join(row).upper()
+        if all(keyword in row_text for keyword in header_keywords):
+            # Clean up the header: remove newlines and extra spaces
+            header = [h.replace('\n', ' ').strip() for h in row]
+            break
+
+    if not header:
+        raise ValueError("Could not find a valid bank statement data header row in the statement.")
+
+    # --- Step 2: Dynamically Map Header Columns ---
+    date_col = next((h for h in header if "DATE" in h.upper() and "VALUE" not in h.upper()), None)
+    desc_col = next((h for h in header if "DESCRIPTION" in h.upper()), None)
+    debit_col = next((h for h in header if "DEBIT" in h.upper()), None)
+    credit_col = next((h for h in header if "CREDIT" in h.upper()), None)
+    balance_col = next((h for h in header if "BALANCE" in h.upper()), None)
+
+    if not all([date_col, desc_col, debit_col, credit_col, balance_col]):
+        raise ValueError("Could not map all required columns from the detected header.")
+
+    column_index = {h: i for i, h in enumerate(header)}
+    date_idx = column_index[date_col]
+    debit_idx = column_index[debit_col]
+    credit_idx = column_index[credit_col]
+    balance_idx = column_index[balance_col]
+    desc_idx = column_index[desc_col]
+
+    # --- Step 3: Detect the Date Format Once from a Sample of Rows ---
+    data_rows = (row for row in reader if row and any(c.strip() for c in row))
+    sample_rows = list(islice(data_rows, DATE_SAMPLE_SIZE))
+    parse_date = detect_bank_date_parser([cell(row, date_idx) for row in sample_rows])
+
+    # --- Step 4: Collect Transactions Column-Wise in Chunks ---
+    builder = TransactionChunkBuilder()
+    for row in chain(sample_rows, data_rows):
+        day = parse_date(cell(row, date_idx))
+        if day is None:
+            continue
+
+        credit = parse_amount(cell(row, credit_idx))
+        debit = parse_amount(cell(row, debit_idx))
+        balance = parse_amount(cell(row, balance_idx))
+        description = cell(row, desc_idx)
+        counterparty = counterparty_id(description)
+
+        # Debit columns may carry a sign or parentheses; only the magnitude is spent
+        if credit > 0:
+            builder.append(day, credit, balance, True, counterparty, categorize(description, True))
+        else:
+            builder.append(day, abs(debit), balance, False, counterparty, categorize(description, False))
+        if builder.full:
+            yield builder.flush()
+
+    if len(builder):
+        yield builder.flush()
+    if parse_date.fallback_count:
+        print(f"{parse_date.fallback_count} date values needed the slow parser.")
+    if builder.rejected_count:
+        print(f"Skipped {builder.rejected_count} rows dated outside the plausible range.")
+
+
+def iter_mtn_momo_chunks(rows, user_id):
+    """
+    Parses the rows of an MTN MoMo statement's tables into TransactionChunks in a
+    single streaming pass. rows is any iterable of cell lists.
+    """
+    print(f"Running analysis for MTN MoMo statement for user: {user_id}")
+
+    reader = iter(rows)
+
+    # --- Step 1: Find Data Header ---
+    header = None
+    header_keywords = ["TRANSACTION DATE", "TRANS. TYPE", "AMOUNT", "BAL AFTER", "FROM NO.", "TO NO."]
+    for row in reader:
+        if all(keyword in ','.join(row).upper() for keyword in header_keywords):
+            header = [h.strip().replace('"', '') for h in row]
+            break
+
+    if not header:
+        raise ValueError("Could not find a valid MTN MoMo data header row in the statement.")
+
+    column_index = {h: i for i, h in enumerate(header)}
+    date_idx = column_index.get("TRANSACTION DATE")
+    type_idx = column_index.get("TRANS. TYPE")
+    amount_idx = column_index.get("AMOUNT")
+    balance_idx = column_index.get("BAL AFTER")
+    from_idx = column_index.get("FROM NO.")
+    to_idx = column_index.get("TO NO.")
+    ref_idx = column_index.get("REF")
+    fees_idx = column_index.get("FEES")
+    levy_idx = column_index.get("E-LEVY")
+
+    # --- Step 2: Collect Transactions Column-Wise in Chunks ---
+    # Income is identified by the user's own number, which is only known once the
+    # first debit or payment is seen. Dated rows before that point are held back
+    # and collected as soon as the number is found.
+    builder = TransactionChunkBuilder()
+    user_phone_suffix = None
+    pending_rows = []
+
+    sample_rows = list(islice(reader, DATE_SAMPLE_SIZE))
+    parse_date = detect_momo_date_parser([cell(row, date_idx) for row in sample_rows])
+
+    for row in chain(sample_rows, reader):
+        if not user_phone_suffix:
+            trans_type = (cell(row, type_idx) or "").upper().strip()
+            if trans_type in ["DEBIT", "PAYMENT"]:
+                from_phone_cleaned = digits_only(cell(row, from_idx))
+                if from_phone_cleaned:
+                    user_phone_suffix = from_phone_cleaned[-9:]
+
+        day = parse_date(cell(row, date_idx))
+        if day is not None:
+            pending_rows.append((
+                day,
+                abs(parse_amount(cell(row, amount_idx))),
+                parse_amount(cell(row, balance_idx)),
+                digits_only(cell(row, from_idx)),
+                digits_only(cell(row, to_idx)),
+                f"{cell(row, type_idx) or ''} {cell(row, ref_idx) or ''}",
+                abs(parse_amount(cell(row, fees_idx))) + abs(parse_amount(cell(row, levy_idx))),
+            ))
+        if not user_phone_suffix:
+            continue
+
+        for day, amount, balance_after, from_phone_cleaned, to_phone_cleaned, description, fee in pending_rows:
+            is_inflow = bool(to_phone_cleaned) and to_phone_cleaned.endswith(user_phone_suffix)
+            # The counterparty is whoever is on the other side of the transfer
+            counterparty = counterparty_id(from_phone_cleaned if is_inflow else to_phone_cleaned)
+            builder.append(day, amount, balance_after, is_inflow, counterparty, categorize(description, is_inflow), fee)
+        pending_rows = []
+        if builder.full:
+            yield builder.flush()
+
+    if not user_phone_suffix:
+        raise ValueError("Could not dynamically identify user's phone number.")
+    if len(builder):
+        yield builder.flush()
+    if parse_date.fallback_count:
+        print(f"{parse_date.fallback_count} date values needed the slow parser.")
+    if builder.rejected_count:
+        print(f"Skipped {builder.rejected_count} rows dated outside the plausible range.")
+
+
+def parse_statement_rows(statement_type, rows, user_id):
+    """Routes a statement's rows to the parser for its type."""
+    if 'momo-mtn-statement' in statement_type:
+        return iter_mtn_momo_chunks(rows, user_id)
+    elif 'bank' in statement_type:
+        return iter_bank_statement_chunks(rows, user_id)
+    raise ValueError(f"No analyzer for type: {statement_type}")
+
+def has_analyzer(statement_type):
+    """True when parse_statement_rows can route this statement type."""
+    return 'momo-mtn-statement' in statement_type or 'bank' in statement_type
@@ -0,0 +1,82 @@
+from datetime import date, datetime
+from decimal import Decimal
+
+# --- Configuration ---
+SUMMARY_FIELDS = [
+    'avgMonthlyIncome',
+    'avgMonthlyExpenditure',
+    'disposableIncome',
+    'avgLowestMonthlyBalance',
+    'balanceVolatility',
+]
+SUMMARY_MAX_STATEMENTS = 12 # Most recent statements kept for the weighted aggregates
+RECENCY_HALF_LIFE_DAYS = 90 # A statement ending this many days before the newest one counts half
+
+# --- Rolling Statement Summary ---
+
+def compact_statement(metric_item):
+    """Keeps only the fields the rolling aggregates need from a statement's metrics."""
+    compact = {k: metric_item[k] for k in SUMMARY_FIELDS if k in metric_item}
+    for key in ('statementType', 'analysisDate', 'periodEnd'):
+        if key in metric_item:
+            compact[key] = metric_item[key]
+    return compact
+
+def statement_end_date(statement):
+    """The date a statement's transactions end, falling back to when it was analyzed."""
+    value = statement.get('periodEnd') or statement.get('analysisDate', '')[:10]
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        return None
+
+def recency_weighted_averages(statements):
+    """Averages the summary fields, halving a statement's weight every RECENCY_HALF_LIFE_DAYS."""
+    end_dates = [statement_end_date(s) for s in statements]
+    newest = max((d for d in end_dates if d), default=None)
+
+    weights = []
+    for end_date in end_dates:
+        age_days = (newest - end_date).days if newest and end_date else 0
+        weights.append(0.5 ** (age_days / RECENCY_HALF_LIFE_DAYS))
+
+    averages = {}
+    for field in SUMMARY_FIELDS:
+        pairs = [(w, float(s[field])) for w, s in zip(weights, statements) if field in s]
+        total_weight = sum(w for w, _ in pairs)
+        if total_weight:
+            averages[field] = Decimal(str(round(sum(w * v for w, v in pairs) / total_weight, 2)))
+    return averages
+
+def statement_order(statement):
+    """Sort key placing the statement whose transactions end last, then the last analyzed, highest."""
+    return (statement.get('periodEnd', ''), statement.get('analysisDate', ''))
+
+def build_statement_summary(previous_summary, metric_item):
+    """
+    Folds a newly analyzed statement into the profile's statementSummary. The summary
+    holds the newest statement's full metrics plus compact copies of the most recent
+    SUMMARY_MAX_STATEMENTS statements and their recency-weighted averages. A backfill
+    or an out-of-order upload does not replace latest with an older statement. The
+    version is used by the writer for optimistic locking.
+    """
+    previous_summary = previous_summary or {}
+    recent = dict(previous_summary.get('recent', {}))
+    recent[metric_item['id']] = compact_statement(metric_item)
+
+    newest_first = sorted(recent.items(), key=lambda entry: statement_order(entry[1]), reverse=True)
+    recent = dict(newest_first[:SUMMARY_MAX_STATEMENTS])
+
+    latest = previous_summary.get('latest')
+    # A re-analysis of the current latest statement always refreshes it
+    if not latest or latest.get('id') == metric_item['id'] or statement_order(metric_item) > statement_order(latest):
+        latest = metric_item
+
+    return {
+        'version': int(previous_summary.get('version', 0)) + 1,
+        'latest': latest,
+        'recent': recent,
+        'weighted': recency_weighted_averages(list(recent.values())),
+        'statementCount': len(recent),
+        'updatedAt': datetime.utcnow().isoformat(),
+    }
@@ -0,0 +1,330 @@
+import numpy as np
+from datetime import date
+from decimal import Decimal
+
+from statements.categorize import CATEGORIES, UNCATEGORIZED, flow_masks
+
+# --- Configuration ---
+CHUNK_SIZE = 8192 # Rows buffered before a chunk is folded into the aggregates
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+EARLIEST_PLAUSIBLE_DATE = date(2000, 1, 1) # Earlier dates are misparses, e.g. a year read as 0001
+FUTURE_DATE_TOLERANCE_DAYS = 31 # Value dates may run a little ahead of today
+
+# --- Day Number Helpers ---
+
+def day_number(date_obj):
+    """Converts a date or datetime into an int64-compatible day number (days since 1970-01-01)."""
+    return date_obj.toordinal() - EPOCH_ORDINAL
+
+def day_to_date(day):
+    """Converts a day number back into a date."""
+    return date.fromordinal(int(day) + EPOCH_ORDINAL)
+
+def plausible_day_range():
+    """
+    The first and last day numbers a transaction may fall on. Rows outside are
+    dropped, since the daily arrays grow with the span between the earliest and
+    latest day and one misparsed date would otherwise widen them by centuries.
+    """
+    return day_number(EARLIEST_PLAUSIBLE_DATE), day_number(date.today()) + FUTURE_DATE_TOLERANCE_DAYS
+
+def month_numbers(days):
+    """Maps an array of day numbers to month numbers (months since 1970-01)."""
+    return np.asarray(days, dtype=np.int64).astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+
+def month_start_day(month):
+    """Day number of the first day of a month number (months since 1970-01)."""
+    return int(np.datetime64(int(month), 'M').astype('datetime64[D]').astype(np.int64))
+
+# --- Columnar Transactions ---
+
+class TransactionChunk:
+    """
+    A block of parsed transactions stored column by column:
+    int64 day numbers, float64 amounts and balances, a boolean inflow mask (money
+    in), int64 counterparty ids (see statements.normalize.counterparty_id), int8
+    category ids (see statements.categorize) and float64 fees charged on top of the
+    amount. Whether an inflow counts as income depends on its category. Rows keep
+    the order they had in the statement.
+    """
+
+    __slots__ = ('day', 'amount', 'balance', 'inflow', 'counterparty', 'category', 'fee')
+
+    def __init__(self, day, amount, balance, inflow, counterparty, category, fee):
+        self.day = day
+        self.amount = amount
+        self.balance = balance
+        self.inflow = inflow
+        self.counterparty = counterparty
+        self.category = category
+        self.fee = fee
+
+    def __len__(self):
+        return len(self.day)
+
+
+class TransactionChunkBuilder:
+    """
+    Collects parsed rows and hands them out as TransactionChunks of at most
+    chunk_size rows. Rows dated outside plausible_day_range() are skipped and
+    counted in rejected_count.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.low_day, self.high_day = plausible_day_range()
+        self.rejected_count = 0
+        self._reset()
+
+    def _reset(self):
+        self.days = []
+        self.amounts = []
+        self.balances = []
+        self.inflows = []
+        self.counterparties = []
+        self.categories = []
+        self.fees = []
+
+    def __len__(self):
+        return len(self.days)
+
+    @property
+    def full(self):
+        return len(self.days) >= self.chunk_size
+
+    def append(self, day, amount, balance, inflow, counterparty=0, category=UNCATEGORIZED, fee=0.0):
+        if not self.low_day <= day <= self.high_day:
+            self.rejected_count += 1
+            return
+        self.days.append(day)
+        self.amounts.append(amount)
+        self.balances.append(balance)
+        self.inflows.append(inflow)
+        self.counterparties.append(counterparty)
+        self.categories.append(category)
+        self.fees.append(fee)
+
+    def flush(self):
+        """Returns the buffered rows as a TransactionChunk and starts a new one."""
+        chunk = TransactionChunk(
+            np.array(self.days, dtype=np.int64),
+            np.array(self.amounts, dtype=np.float64),
+            np.array(self.balances, dtype=np.float64),
+            np.array(self.inflows, dtype=bool),
+            np.array(self.counterparties, dtype=np.int64),
+            np.array(self.categories, dtype=np.int8),
+            np.array(self.fees, dtype=np.float64),
+        )
+        self._reset()
+        return chunk
+
+# --- Aggregation ---
+
+class StatementAggregates:
+    """
+    Per-day income, expenditure and lowest balance arrays for a statement, plus
+    per-category amounts and counts (one row per category id).
+    Chunks are folded in with np.bincount and np.minimum.at, so memory is bounded
+    by the number of days a statement covers rather than the number of rows.
+    Rows dated outside plausible_day_range() are counted in rejected_count and
+    never widen the arrays.
+    """
+
+    def __init__(self):
+        self.first_day = None
+        self.latest_day = None
+        self.row_count = 0
+        self.rejected_count = 0
+        self.low_day, self.high_day = plausible_day_range()
+        self.income = np.zeros(0, dtype=np.float64)
+        self.expenditure = np.zeros(0, dtype=np.float64)
+        self.lowest_balance = np.zeros(0, dtype=np.float64)
+        self.category_amount = np.zeros((len(CATEGORIES), 0), dtype=np.float64)
+        self.category_count = np.zeros((len(CATEGORIES), 0), dtype=np.int64)
+        self._month_index = None
+
+    def _cover(self, low_day, high_day):
+        """Grows the daily arrays so they span low_day..high_day."""
+        if self.first_day is None:
+            self.first_day = low_day
+        pad_before = max(self.first_day - low_day, 0)
+        pad_after = max(high_day - (self.first_day + len(self.income) - 1), 0)
+        if pad_before or pad_after:
+            self.income = np.pad(self.income, (pad_before, pad_after))
+            self.expenditure = np.pad(self.expenditure, (pad_before, pad_after))
+            self.lowest_balance = np.pad(self.lowest_balance, (pad_before, pad_after), constant_values=np.inf)
+            self.category_amount = np.pad(self.category_amount, ((0, 0), (pad_before, pad_after)))
+            self.category_count = np.pad(self.category_count, ((0, 0), (pad_before, pad_after)))
+            self.first_day -= pad_before
+
+    def add(self, chunk):
+        """Folds a TransactionChunk into the daily totals."""
+        if not len(chunk):
+            return
+
+        day, amount, balance, inflow, category = chunk.day, chunk.amount, chunk.balance, chunk.inflow, chunk.category
+        in_range = (day >= self.low_day) & (day <= self.high_day)
+        if not in_range.all():
+            # Chunks from older caches were built before the parsers dropped these rows
+            self.rejected_count += int((~in_range).sum())
+            day, amount, balance, inflow, category = day[in_range], amount[in_range], balance[in_range], inflow[in_range], category[in_range]
+            if not len(day):
+                return
+
+        low_day, high_day = int(day.min()), int(day.max())
+        self._cover(low_day, high_day)
+        if self.latest_day is None or high_day > self.latest_day:
+            self.latest_day = high_day
+
+        index = day - self.first_day
+        size = len(self.income)
+        income, spending = flow_masks(inflow, category)
+        self.income += np.bincount(index, weights=np.where(income, amount, 0.0), minlength=size)
+        self.expenditure += np.bincount(index, weights=np.where(spending, amount, 0.0), minlength=size)
+        np.minimum.at(self.lowest_balance, index, balance)
+
+        # One bincount covers every category: category id * days + day index
+        cells = category.astype(np.int64) * size + index
+        self.category_amount += np.bincount(cells, weights=amount, minlength=len(CATEGORIES) * size).reshape(len(CATEGORIES), size)
+        self.category_count += np.bincount(cells, minlength=len(CATEGORIES) * size).reshape(len(CATEGORIES), size)
+        self.row_count += len(day)
+        self._month_index = None
+
+    def month_index(self):
+        """
+        Month number of every aggregated day, relative to the first month. Computed
+        once after the last chunk so every window reuses the same mapping.
+        """
+        if self._month_index is None:
+            days = np.arange(self.first_day, self.first_day + len(self.income), dtype=np.int64)
+            months = month_numbers(days)
+            self._month_index = months - months[0] if len(months) else months
+        return self._month_index
+
+    def monthly(self, since_day):
+        """
+        Rolls the daily totals on or after since_day up into calendar months.
+        Returns (income, expenditure, lowest_balance) arrays with one entry per month.
+        """
+        start = max(since_day - self.first_day, 0)
+        if start >= len(self.income):
+            empty = np.zeros(0, dtype=np.float64)
+            return empty, empty, empty
+
+        month_index = self.month_index()[start:]
+        month_index = month_index - month_index[0]
+        month_count = int(month_index[-1]) + 1
+
+        income = np.bincount(month_index, weights=self.income[start:], minlength=month_count)
+        expenditure = np.bincount(month_index, weights=self.expenditure[start:], minlength=month_count)
+        lowest_balance = np.full(month_count, np.inf)
+        np.minimum.at(lowest_balance, month_index, self.lowest_balance[start:])
+        return income, expenditure, lowest_balance
+
+# --- Metrics ---
+
+def get_data_without_outliers(data_points):
+    """Identifies and removes outliers from an array of numbers using the 3-sigma rule."""
+    data_points = np.asarray(data_points, dtype=np.float64)
+    if len(data_points) < 3:
+        return data_points, data_points[:0]
+
+    mean = data_points.mean()
+    stdev = data_points.std(ddof=1)
+    if stdev == 0:
+        return data_points, data_points[:0]
+
+    is_outlier = np.abs(data_points - mean) > 3 * stdev
+    return data_points[~is_outlier], np.unique(data_points[is_outlier])
+
+def statement_period(aggregates):
+    """Returns the first and last transaction dates of an aggregated statement."""
+    return {
+        'periodStart': day_to_date(aggregates.first_day).isoformat(),
+        'periodEnd': day_to_date(aggregates.latest_day).isoformat(),
+    }
+
+def to_decimal(value):
+    return Decimal(str(round(float(value), 2)))
+
+def summarize_months(monthly_income, monthly_expenditure, monthly_lowest_balance, verbose=False):
+    """
+    Turns per-month income, expenditure and lowest balance arrays into the metric
+    dictionary. Months without a lowest balance should hold np.inf.
+    """
+    # Only months with money moving in (or out) count towards the averages
+    income_values = monthly_income[monthly_income > 0]
+    expenditure_values = monthly_expenditure[monthly_expenditure > 0]
+
+    income_no_outliers, _ = get_data_without_outliers(income_values)
+    expenditure_no_outliers, expenditure_outliers = get_data_without_outliers(expenditure_values)
+    if verbose:
+        print(f"Income: {income_no_outliers.round(2).tolist()}")
+        print(f"Expenditure: {expenditure_no_outliers.round(2).tolist()}")
+
+    avg_monthly_income = income_no_outliers.mean() if len(income_no_outliers) else 0.0
+    avg_monthly_expenditure = expenditure_no_outliers.mean() if len(expenditure_no_outliers) else 0.0
+    disposable_income = avg_monthly_income - avg_monthly_expenditure
+
+    lowest_balance_values = monthly_lowest_balance[np.isfinite(monthly_lowest_balance)]
+    avg_lowest_monthly_balance = lowest_balance_values.mean() if len(lowest_balance_values) else 0.0
+    balance_volatility = lowest_balance_values.std(ddof=1) if len(lowest_balance_values) > 1 else 0.0
+
+    return {
+        'avgMonthlyIncome': to_decimal(avg_monthly_income),
+        'avgMonthlyExpenditure': to_decimal(avg_monthly_expenditure),
+        'disposableIncome': to_decimal(disposable_income),
+        'avgLowestMonthlyBalance': to_decimal(avg_lowest_monthly_balance),
+        'balanceVolatility': to_decimal(balance_volatility),
+        'expenditureOutlierCount': len(expenditure_outliers),
+    }
+
+def category_totals(aggregates, since_day, month_count):
+    """Total, monthly average and count per category on or after since_day."""
+    start = max(since_day - aggregates.first_day, 0)
+    amounts = aggregates.category_amount[:, start:].sum(axis=1)
+    counts = aggregates.category_count[:, start:].sum(axis=1)
+    totals = {}
+    for category_id, name in enumerate(CATEGORIES):
+        if category_id == UNCATEGORIZED or not counts[category_id]:
+            continue
+        totals[name] = {
+            'total': to_decimal(amounts[category_id]),
+            'monthlyAverage': to_decimal(amounts[category_id] / max(month_count, 1)),
+            'count': int(counts[category_id]),
+        }
+    return totals
+
+def metrics_since(aggregates, since_day, verbose=False):
+    """Computes the statement metrics over the aggregated days on or after since_day."""
+    monthly = aggregates.monthly(since_day)
+    metrics = summarize_months(*monthly, verbose=verbose)
+    metrics['categoryTotals'] = category_totals(aggregates, since_day, len(monthly[0]))
+    return metrics
+
+def calculate_statement_metrics(aggregates, window_days, verbose=True):
+    """Computes the statement metrics over the most recent window_days of the aggregated days."""
+    window_start = aggregates.latest_day - window_days
+    if verbose:
+        print(f"Analysis window: {day_to_date(window_start)} to {day_to_date(aggregates.latest_day)}")
+    return metrics_since(aggregates, window_start, verbose)
+
+def calculate_window_metrics(aggregates, window_months):
+    """
+    Computes the statement metrics for several trailing windows from the same
+    aggregates. Returns a map keyed like '3m'. A window covers that many calendar
+    months up to and including the month of the latest transaction, the same
+    windows the ledger and consolidated metrics use. Each entry also records the
+    window start and how many days in the window had transactions.
+    """
+    latest_month = int(month_numbers([aggregates.latest_day])[0])
+    windows = {}
+    for months in window_months:
+        window_start = month_start_day(latest_month - months + 1)
+        metrics = metrics_since(aggregates, window_start)
+        start = max(window_start - aggregates.first_day, 0)
+        active_days = (aggregates.income[start:] != 0) | (aggregates.expenditure[start:] != 0)
+        metrics['windowStart'] = day_to_date(aggregates.first_day + start).isoformat()
+        metrics['activeDays'] = int(active_days.sum())
+        windows[f"{months}m"] = metrics
+    return windows
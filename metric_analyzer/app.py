@@ -1,395 +1,628 @@
 import json
 import boto3
+from botocore.exceptions import ClientError
 import os
 import csv
+import posixpath
+import codecs
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
-from collections import defaultdict
-import re
-from datetime import datetime, timedelta
-import statistics
-from decimal import Decimal
+from datetime import datetime
+
+from statements.transactions import (
+    StatementAggregates,
+    calculate_statement_metrics,
+    calculate_window_metrics,
+    statement_period,
+)
+from statements.parsers import (
+    iter_bank_statement_chunks,
+    iter_mtn_momo_chunks,
+    parse_statement_rows,
+)
+from statements.integrity import IntegrityChecker
+from statements.summary import build_statement_summary
+from statements.columnar import (
+    GENERATION_METADATA,
+    ChunkSpool,
+    ColumnarFormatError,
+    ColumnarWriter,
+    columnar_key_for,
+    iter_columnar_chunks,
+    read_columnar_header,
+)
+from statements.dedup import CONTENT_HASH_METADATA, DynamoDBStatementIndex
+from statements.ledger import TransactionLedger, ledger_key_for, ledger_prefix_for
+from statements.consolidate import consolidated_metrics
 
 # --- Configuration ---
 DYNAMODB_TABLE = os.environ.get('CREDIT_PROFILE_TABLE')
+ANALYSIS_WINDOW_DAYS = 180 # Roughly the most recent 6 months of a statement
+ANALYSIS_WINDOWS_MONTHS = [int(m) for m in os.environ.get('ANALYSIS_WINDOWS_MONTHS', '1,3,6,12').split(',') if m.strip()]
+STREAM_CHUNK_SIZE = 64 * 1024 # Bytes read from S3 per decode step
+SUMMARY_WRITE_ATTEMPTS = 5 # Optimistic-lock retries when statementSummary changes underneath us
+COLUMNAR_SPOOL_SIZE = 8 * 1024 * 1024 # Columnar cache bytes kept in memory before spilling to /tmp
+LEDGER_WRITE_ATTEMPTS = 5 # Conditional-put retries when another invocation updated the same ledger
+MAX_CONCURRENT_USERS = int(os.environ.get('ANALYZER_MAX_WORKERS', '4')) # Users whose records are processed in parallel
+STATEMENT_INDEX_TABLE = os.environ.get('STATEMENT_INDEX_TABLE') # Content-hash index shared with the converter
+STATEMENT_METRICS_TABLE = os.environ.get('STATEMENT_METRICS_TABLE') # Per-statement metrics, one item per userId and statementId
 
 # --- AWS Client Initialization ---
+# Clients are thread-safe and shared. Resources are not, so each worker thread
+# builds its own Table from its own session (see get_profile_table).
 s3_client = boto3.client('s3')
-dynamodb_resource = boto3.resource('dynamodb')
-table = dynamodb_resource.Table(DYNAMODB_TABLE)
+thread_state = threading.local()
+
+def get_profile_table():
+    """Returns the credit profile Table for the current thread."""
+    table = getattr(thread_state, 'table', None)
+    if table is None:
+        table = boto3.session.Session().resource('dynamodb').Table(DYNAMODB_TABLE)
+        thread_state.table = table
+    return table
+
+def get_statement_metrics_table():
+    """Returns the per-statement metrics Table for the current thread."""
+    table = getattr(thread_state, 'statement_metrics_table', None)
+    if table is None:
+        table = boto3.session.Session().resource('dynamodb').Table(STATEMENT_METRICS_TABLE)
+        thread_state.statement_metrics_table = table
+    return table
+
+def get_statement_index():
+    """
+    Returns the content-hash statement index for the current thread, or None when
+    deduplication is not configured. Tests can patch this to return an
+    InMemoryStatementIndex.
+    """
+    if not STATEMENT_INDEX_TABLE:
+        return None
+    index = getattr(thread_state, 'statement_index', None)
+    if index is None:
+        index = DynamoDBStatementIndex(boto3.session.Session().resource('dynamodb').Table(STATEMENT_INDEX_TABLE))
+        thread_state.statement_index = index
+    return index
+
+# --- Streaming Helpers ---
+
+def iter_text_lines(body, encoding='utf-8-sig', chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Decodes a binary stream (e.g. an S3 StreamingBody) incrementally and yields
+    text lines with their line endings, so the whole file is never held in memory.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ''
+    while True:
+        chunk = body.read(chunk_size)
+        if not chunk:
+            break
+        pending += decoder.decode(chunk)
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+def as_line_iterable(csv_content):
+    """Accepts either the full CSV text or an iterable of lines."""
+    if isinstance(csv_content, str):
+        return StringIO(csv_content)
+    return csv_content
+
+def csv_rows(csv_content):
+    """Reads CSV text or an iterable of lines as rows of cells."""
+    return csv.reader(as_line_iterable(csv_content))
+
+def iter_statement_chunks(statement_type, csv_content, user_id):
+    """Parses a processed statement CSV into TransactionChunks with the parser for its type."""
+    return parse_statement_rows(statement_type, csv_rows(csv_content), user_id)
+
 
-# --- Helper Functions ---
+# --- Analysis ---
 
-def clean_numeric(value_string):
-    """Cleans a string to extract a float, handling commas and other characters."""
-    if not isinstance(value_string, str):
-        return 0.0
+def analyze_chunks(chunks):
+    """
+    Folds TransactionChunks into daily aggregates and computes the statement metrics,
+    checking the rows for signs of tampering in the same pass.
+    """
+    aggregates = StatementAggregates()
+    integrity = IntegrityChecker()
+    for chunk in chunks:
+        aggregates.add(chunk)
+        integrity.add(chunk)
+
+    if aggregates.latest_day is None:
+        raise ValueError("Could not parse any valid transaction dates from the statement.")
+
+    metrics = calculate_statement_metrics(aggregates, ANALYSIS_WINDOW_DAYS)
+    metrics['windows'] = calculate_window_metrics(aggregates, ANALYSIS_WINDOWS_MONTHS)
+    metrics.update(statement_period(aggregates))
+    metrics['integrity'] = integrity.result()
+    print(f"Integrity check: {metrics['integrity']}")
+    return metrics
+
+def analyze_bank_statement_csv(csv_content, user_id):
+    """Performs data analysis on a processed bank statement CSV."""
+    return analyze_chunks(iter_bank_statement_chunks(csv_rows(csv_content), user_id))
+
+def analyze_mtn_momo_csv(csv_content, user_id):
+    """Performs data analysis on the most recent 6 months of transactions from a MoMo statement."""
+    return analyze_chunks(iter_mtn_momo_chunks(csv_rows(csv_content), user_id))
+
+# --- Columnar Transaction Cache ---
+
+def read_csv_metadata(bucket, csv_key):
+    """The user metadata the converter stored on a processed CSV, or {} when it cannot be read."""
     try:
-        cleaned_str = re.sub(r'[^\d.]', '', value_string)
-        return float(cleaned_str) if cleaned_str else 0.0
-    except (ValueError, TypeError):
-        return 0.0
-
-def parse_momo_date(date_string):
-    """Parses the specific date format from the MTN statement."""
-    if not date_string:
+        return s3_client.head_object(Bucket=bucket, Key=csv_key).get('Metadata', {})
+    except ClientError:
+        return {}
+
+def cache_matches_source(bucket, csv_key, header, source_token, generation=None):
+    """
+    True when a columnar file was built from this version of the CSV: either we
+    built it from the CSV with this ETag, or both carry the same generation token
+    (the converter wrote them together, or the CSV is a copy of the one the file
+    was built from). generation is the CSV's token when the caller already has it.
+    """
+    if header.get('sourceToken') == source_token:
+        return True
+    cached_generation = header.get('generation')
+    if not cached_generation:
+        return False
+    if generation is None:
+        generation = read_csv_metadata(bucket, csv_key).get(GENERATION_METADATA)
+    return generation == cached_generation
+
+def load_cached_chunks(bucket, csv_key, source_token, generation=None):
+    """
+    Opens the columnar file stored beside a processed CSV. Returns an iterator over
+    its chunks, or None when it is missing, from another schema version, or was
+    built from a different version of the CSV.
+    """
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=columnar_key_for(csv_key))
+    except ClientError:
+        # NoSuchKey, or AccessDenied since the role cannot list the bucket
         return None
+
+    body = response['Body']
     try:
-        cleaned_date_string = re.sub(r'(\d{2}-\w{3}-\d{4})[-\s]', r'\1 ', date_string.strip())
-        return datetime.strptime(cleaned_date_string, '%d-%b-%Y %I:%M:%S %p')
-    except (ValueError, TypeError):
+        header = read_columnar_header(body)
+    except ColumnarFormatError as e:
+        print(f"Ignoring columnar cache for {csv_key}: {e}")
+        body.close()
         return None
 
-def parse_bank_date(date_string):
-    """Parses common date formats found in bank statements by trying multiple formats."""
-    if not isinstance(date_string, str) or not date_string.strip():
+    if not cache_matches_source(bucket, csv_key, header, source_token, generation):
+        print(f"Ignoring columnar cache for {csv_key}: it was built from another version of the CSV.")
+        body.close()
         return None
-    
-    # List of formats to try in order of expected frequency
-    formats_to_try = [
-        '%d/%m/%Y',      # e.g., 21/07/2025
-        '%d-%b-%Y',      # e.g., 21-Jul-2025
-        '%Y-%m-%d',      # e.g., 2025-07-21
-        '%d-%m-%Y',      # e.g., 21-07-2025
-    ]
-    
-    for fmt in formats_to_try:
-        try:
-            return datetime.strptime(date_string.strip(), fmt)
-        except (ValueError, TypeError):
-            continue # Try the next format
-            
-    # If all formats fail, return None
-    return None
-
-def get_data_without_outliers(data_points):
-    """Identifies and removes outliers from a list of numbers using the 3-sigma rule."""
-    if len(data_points) < 3:
-        return data_points, []
-        
-    mean = statistics.mean(data_points)
-    stdev = statistics.stdev(data_points)
-    
-    if stdev == 0:
-        return data_points, []
-        
-    outlier_threshold = 3 * stdev
-    outliers = {p for p in data_points if abs(p - mean) > outlier_threshold}
-    clean_data = [p for p in data_points if p not in outliers]
-    
-    return clean_data, list(outliers)
-
-
-# --- Provider-Specific Analysis Functions ---
+    return iter_columnar_chunks(body)
 
-def analyze_bank_statement_csv(csv_content, user_id):
+def collect_chunks(chunks, chunk_sink):
+    """Passes chunks through while appending each one to chunk_sink."""
+    for chunk in chunks:
+        chunk_sink.append(chunk)
+        yield chunk
+
+def analyze_statement(bucket, csv_key, statement_type, user_id, source_token=None, chunk_sink=None, generation=None):
     """
-    Performs data analysis on a processed bank statement CSV.
-    This version uses the csv module to correctly handle multi-line headers.
-    """
-    print(f"Running analysis for Bank Statement CSV for user: {user_id}")
-    
-    csv_file = StringIO(csv_content)
-    reader = csv.reader(csv_file)
-    
-    header = None
-    data_rows_as_lists = []
-    header_found = False
-
-    # --- Step 1: Find Header and Collect Data Rows ---
-    for row in reader:
-        if header_found:
-            # Append non-empty rows to our data list
-            if row and any(cell.strip() for cell in row):
-                data_rows_as_lists.append(row)
-            continue
-
-        # Check if the current row is the header by looking for keywords
-        row_text = ' '.join(row).upper()
-        header_keywords = ["DATE", "DESCRIPTION", "DEBIT", "CREDIT", "BALANCE"]
-        
-        if all(keyword in row_text for keyword in header_keywords):
-            # Clean up the header: remove newlines and extra spaces
-            header = [h.replace('\n', ' ').strip() for h in row]
-            header_found = True
-
-    if not header:
-        raise ValueError("Could not find a valid bank statement data header row in the CSV.")
-
-    # --- Step 2: Dynamically Map Header Columns and Parse Transactions ---
-    # Find column names dynamically from the cleaned header list
-    date_col = next((h for h in header if "DATE" in h.upper() and "VALUE" not in h.upper()), None)
-    desc_col = next((h for h in header if "DESCRIPTION" in h.upper()), None)
-    debit_col = next((h for h in header if "DEBIT" in h.upper()), None)
-    credit_col = next((h for h in header if "CREDIT" in h.upper()), None)
-    balance_col = next((h for h in header if "BALANCE" in h.upper()), None)
-
-    if not all([date_col, desc_col, debit_col, credit_col, balance_col]):
-        raise ValueError("Could not map all required columns from the detected header.")
-
-    all_transactions = []
-    latest_date = None
-
-    for row_list in data_rows_as_lists:
-        row_dict = dict(zip(header, row_list))
-        
-        date_obj = parse_bank_date(row_dict.get(date_col))
-        if not date_obj:
-            continue
-        
-        if latest_date is None or date_obj > latest_date:
-            latest_date = date_obj
-
-        all_transactions.append({
-            'date': date_obj,
-            'description': row_dict.get(desc_col, "").upper(),
-            'debit': clean_numeric(row_dict.get(debit_col)),
-            'credit': clean_numeric(row_dict.get(credit_col)),
-            'balance': clean_numeric(row_dict.get(balance_col))
+    Analyzes a processed statement. A current columnar cache is read directly;
+    otherwise the CSV is parsed and the cache is rebuilt during the same pass.
+    source_token identifies the CSV version (its ETag); without it no cache is used.
+    When chunk_sink is given (a ChunkSpool or a list), the parsed TransactionChunks
+    are appended to it.
+    generation is the CSV's generation token, if the caller has already read it.
+    """
+    cached_chunks = load_cached_chunks(bucket, csv_key, source_token, generation) if source_token else None
+    if cached_chunks is not None:
+        print(f"Using columnar cache for {csv_key}")
+        if chunk_sink is not None:
+            cached_chunks = collect_chunks(cached_chunks, chunk_sink)
+        return analyze_chunks(cached_chunks)
+
+    response = s3_client.get_object(Bucket=bucket, Key=csv_key)
+    generation = response.get('Metadata', {}).get(GENERATION_METADATA, generation)
+    chunks = iter_statement_chunks(statement_type, iter_text_lines(response['Body']), user_id)
+    if chunk_sink is not None:
+        chunks = collect_chunks(chunks, chunk_sink)
+    if not source_token:
+        return analyze_chunks(chunks)
+
+    with tempfile.SpooledTemporaryFile(max_size=COLUMNAR_SPOOL_SIZE) as buffer:
+        writer = ColumnarWriter(buffer, {
+            'sourceKey': csv_key,
+            'sourceToken': source_token,
+            'generation': generation,
+            'statementType': statement_type,
         })
+        metrics = analyze_chunks(writer.tee(chunks))
 
-    if not latest_date:
-        raise ValueError("Could not parse any valid dates from the bank statement CSV.")
-
-    # --- Step 3: Define 6-Month Window and Categorize Transactions ---
-    six_months_ago = latest_date - timedelta(days=180)
-
-    monthly_income = defaultdict(float)
-    monthly_expenditure = defaultdict(float)
-    monthly_lowest_balance = defaultdict(lambda: float('inf'))
-
-    for trans in all_transactions:
-        date_obj = trans['date']
-        if date_obj < six_months_ago:
-            continue
-
-        month_key = date_obj.strftime('%Y-%m')
-
-        if trans['balance'] < monthly_lowest_balance[month_key]:
-            monthly_lowest_balance[month_key] = trans['balance']
-
-        if trans['credit'] > 0:
-            monthly_income[month_key] += trans['credit']
-        elif trans['debit'] > 0:
-            monthly_expenditure[month_key] += trans['debit']
-
-    
-    income_values = list(monthly_income.values())
-    expenditure_values = list(monthly_expenditure.values())
-    
-    income_no_outliers, _ = get_data_without_outliers(income_values)
-    expenditure_no_outliers, expenditure_outliers = get_data_without_outliers(expenditure_values)
-    print(f"Income: {income_no_outliers}")
-    print(f"Expenditure: {expenditure_no_outliers}")
-
-    # Calculate final averages from the cleaned data
-    avg_monthly_income = statistics.mean(income_no_outliers) if income_no_outliers else 0.0
-    avg_monthly_expenditure = statistics.mean(expenditure_no_outliers) if expenditure_no_outliers else 0.0
-    disposable_income = avg_monthly_income - avg_monthly_expenditure 
-    
-    lowest_balance_values = [v for v in monthly_lowest_balance.values() if v != float('inf')]
-    avg_lowest_monthly_balance = statistics.mean(lowest_balance_values) if lowest_balance_values else 0.0
-    balance_volatility = statistics.stdev(lowest_balance_values) if len(lowest_balance_values) > 1 else 0.0
-    
-    return {
-        'avgMonthlyIncome': Decimal(str(round(avg_monthly_income, 2))),
-        'avgMonthlyExpenditure': Decimal(str(round(avg_monthly_expenditure, 2))),
-        'disposableIncome': Decimal(str(round(disposable_income, 2))),
-        'avgLowestMonthlyBalance': Decimal(str(round(avg_lowest_monthly_balance, 2))),
-        'balanceVolatility': Decimal(str(round(balance_volatility, 2))),
-        'expenditureOutlierCount': len(expenditure_outliers),
-    }
+        buffer.seek(0)
+        try:
+            s3_client.put_object(
+                Bucket=bucket,
+                Key=columnar_key_for(csv_key),
+                Body=buffer,
+                ContentType='application/octet-stream'
+            )
+            print(f"Saved columnar cache with {writer.row_count} transactions for {csv_key}")
+        except Exception as e:
+            # The cache is an optimization; the analysis itself succeeded
+            print(f"Warning: could not save columnar cache for {csv_key}: {e}")
+    return metrics
 
+# --- Deduplication ---
 
-def analyze_mtn_momo_csv(csv_content, user_id):
+def load_indexed_metrics(bucket, csv_key, user_id, digest, generation, source_token, chunk_sink):
     """
-    Performs data analysis on the most recent 6 months of transactions from a MoMo statement.
+    Returns the metrics already computed from this conversion of the user's document
+    (the CSV was re-delivered, or copied by the converter for a duplicate upload), or
+    None. The ledger still needs the transactions, so metrics are only reused when
+    the columnar cache can supply them; its chunks are appended to chunk_sink.
     """
-    print(f"Running analysis for MTN MoMo statement for user: {user_id}")
-    
-    lines = csv_content.splitlines()
-    header = None
-    data_start_line = 0
+    index = get_statement_index()
+    if index is None or not digest or not generation:
+        return None
+    entry = index.get(user_id, digest)
+    if not entry or entry.get('metricsGeneration') != generation:
+        return None
+    cached_chunks = load_cached_chunks(bucket, csv_key, source_token, generation)
+    if cached_chunks is None:
+        return None
+    chunk_sink.extend(cached_chunks)
+    print(f"Reusing metrics of an identical statement for {csv_key}")
+    return entry['metrics']
+
+def index_statement_metrics(user_id, digest, generation, metrics_data):
+    """Stores a conversion's metrics in the statement index so duplicates can reuse them."""
+    index = get_statement_index()
+    if index is None or not digest or not generation:
+        return
+    try:
+        index.record_metrics(user_id, digest, generation, metrics_data)
+    except Exception as e:
+        # Only an optimization for later duplicates
+        print(f"Warning: could not index metrics for {digest}: {e}")
 
-    # --- Step 1: Find Data Header ---
-    for i, line in enumerate(lines):
-        header_keywords = ["TRANSACTION DATE", "TRANS. TYPE", "AMOUNT", "BAL AFTER", "FROM NO.", "TO NO."]
-        if all(keyword in line.upper() for keyword in header_keywords):
-            header = [h.strip().replace('"', '') for h in line.split(',')]
-            data_start_line = i + 1
-            break
-            
-    if not header:
-        raise ValueError("Could not find a valid MTN MoMo data header row in the CSV.")
-
-    # --- Step 2: Pre-scan to Find Date Range and Phone Number ---
-    all_transactions = []
-    latest_date = None
-    user_phone_suffix = None
-    
-    reader_prescan = csv.DictReader(lines[data_start_line:], fieldnames=header)
-    for row in reader_prescan:
-        date_obj = parse_momo_date(row.get("TRANSACTION DATE"))
-        if date_obj:
-            all_transactions.append((date_obj, row))
-            if latest_date is None or date_obj > latest_date:
-                latest_date = date_obj
-        
-        if not user_phone_suffix:
-            trans_type = row.get("TRANS. TYPE", "").upper().strip()
-            if trans_type in ["DEBIT", "PAYMENT"]:
-                from_phone_raw = row.get("FROM NO.", "").strip()
-                if from_phone_raw:
-                    from_phone_cleaned = re.sub(r'\D', '', from_phone_raw)
-                    if from_phone_cleaned:
-                        user_phone_suffix = from_phone_cleaned[-9:]
-
-    if not user_phone_suffix:
-        raise ValueError("Could not dynamically identify user's phone number.")
-    if not latest_date:
-        raise ValueError("Could not find any valid transaction dates in the statement.")
-
-    # --- Step 3: Define 6-Month Window and Categorize Transactions ---
-    six_months_ago = latest_date - timedelta(days=180)
-    print(f"Analysis window: {six_months_ago.strftime('%Y-%m-%d')} to {latest_date.strftime('%Y-%m-%d')}")
-
-    monthly_income = defaultdict(float)
-    monthly_expenditure = defaultdict(float)
-    monthly_lowest_balance = defaultdict(lambda: float('inf'))
-
-    for date_obj, row in all_transactions:
-        if date_obj < six_months_ago:
-            continue
-
-        month_key = date_obj.strftime('%Y-%m')
-        balance_after = clean_numeric(row.get("BAL AFTER"))
-        if balance_after < monthly_lowest_balance[month_key]:
-            monthly_lowest_balance[month_key] = balance_after
-        
-        trans_type = row.get("TRANS. TYPE", "").upper().strip()
-        to_phone_cleaned = re.sub(r'\D', '', row.get("TO NO.", "").strip())
-        amount = clean_numeric(row.get("AMOUNT"))
-        
-        is_income = (
-            to_phone_cleaned and 
-            to_phone_cleaned.endswith(user_phone_suffix)
-        )
-        
-        if is_income:
-            monthly_income[month_key] += amount
-        else:
-            monthly_expenditure[month_key] += amount
-
-    # --- Step 4: Calculate Final Metrics ---
-    income_values = list(monthly_income.values())
-    expenditure_values = list(monthly_expenditure.values())
-    print(income_values)
-    print(expenditure_values)
-    
-    income_no_outliers, _ = get_data_without_outliers(income_values)
-    expenditure_no_outliers, expenditure_outliers = get_data_without_outliers(expenditure_values)
-    print(income_no_outliers)
-    print(expenditure_no_outliers)
-    avg_monthly_income = statistics.mean(income_no_outliers) if income_no_outliers else 0.0
-    avg_monthly_expenditure = statistics.mean(expenditure_no_outliers) if expenditure_no_outliers else 0.0
-    print(avg_monthly_income)
-    print(avg_monthly_expenditure)
-
-    lowest_balance_values = [v for v in monthly_lowest_balance.values() if v != float('inf')]
-    avg_lowest_monthly_balance = statistics.mean(lowest_balance_values) if lowest_balance_values else 0.0
-    
-    disposable_income = avg_monthly_income - avg_monthly_expenditure
-    print(disposable_income)
-    balance_volatility = statistics.stdev(lowest_balance_values) if len(lowest_balance_values) > 1 else 0.0
-    
-    return {
-        'avgMonthlyIncome': Decimal(str(round(avg_monthly_income, 2))),
-        'avgMonthlyExpenditure': Decimal(str(round(avg_monthly_expenditure, 2))),
-        'disposableIncome': Decimal(str(round(disposable_income, 2))),
-        'avgLowestMonthlyBalance': Decimal(str(round(avg_lowest_monthly_balance, 2))),
-        'balanceVolatility': Decimal(str(round(balance_volatility, 2))),
-        'expenditureOutlierCount': len(expenditure_outliers),
-    }
+# --- Transaction Ledger ---
 
-# --- Main Lambda Handler (Router) ---
+def load_ledger(bucket, ledger_key):
+    """
+    Reads a user's ledger. Returns (ledger, etag); a missing ledger, or one written
+    with an older schema, comes back empty (the etag still guards the overwrite).
+    """
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=ledger_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        return TransactionLedger(), None
 
-def lambda_handler(event, context):
+    body = response['Body']
+    try:
+        ledger = TransactionLedger.read(body)
+    finally:
+        body.close()
+    if ledger.stale:
+        print(f"Starting a new ledger at {ledger_key}: it was written with an older schema. "
+              f"Re-run the backfill to restore older statements.")
+    return ledger, response['ETag']
+
+def write_ledger(bucket, ledger_key, ledger, etag):
     """
-    This Lambda is triggered by S3. It routes to the correct analysis function
-    and appends or updates the results in the 'perStatement' list in DynamoDB.
+    Replaces a ledger with a conditional put against the etag it was read at.
+    Returns False when another writer changed it in the meantime.
     """
-    for record in event['Records']:
+    conditions = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+    with tempfile.SpooledTemporaryFile(max_size=COLUMNAR_SPOOL_SIZE) as buffer:
+        ledger.write(buffer)
+        buffer.seek(0)
         try:
-            source_bucket = record['s3']['bucket']['name']
-            source_key = record['s3']['object']['key']
-            
-            parts = source_key.split('/')
-            if len(parts) < 3:
-                raise ValueError(f"Invalid S3 key format: {source_key}")
-            
-            statement_type = parts[1]
-            user_id = parts[2]
-            file_name = os.path.basename(source_key)
-
-            print(f"Routing analysis for statement: {statement_type} for user: {user_id}")
-
-            response = s3_client.get_object(Bucket=source_bucket, Key=source_key)
-            content = response['Body'].read().decode('utf-8-sig')
-            
-            metrics_data = None
-            if 'momo-mtn-statement' in statement_type:
-                metrics_data = analyze_mtn_momo_csv(content, user_id)
-            elif 'bank' in statement_type:
-                metrics_data = analyze_bank_statement_csv(content, user_id)
-            else:
-                raise ValueError(f"No analyzer for type: {statement_type}")
-
-            new_metric_item = {
-                'id': file_name, # Unique ID for the statement analysis
-                'sourceFile': source_key,
-                'statementType': statement_type,
-                'analysisDate': datetime.utcnow().isoformat()
-            }
-            new_metric_item.update(metrics_data)
-            
-            print(f"Analysis complete. Metrics: {new_metric_item}")
-
-            # --- Update or Append Logic ---
-            # 1. Get the current user profile
-            user_profile = table.get_item(Key={'userId': user_id}).get('Item', {})
-            # Get the existing statementMetrics object, or create one if it doesn't exist
-            statement_metrics = user_profile.get('statementMetrics', {'perStatement': []})
-            per_statement_list = statement_metrics.get('perStatement', [])
-
-            # 2. Check if an item with the same ID exists
-            found_index = -1
-            for i, item in enumerate(per_statement_list):
-                if item.get('id') == file_name:
-                    found_index = i
-                    break
-            
-            # 3. Update the list in memory
-            if found_index != -1:
-                print(f"Updating existing statement metric at index {found_index}")
-                per_statement_list[found_index] = new_metric_item
-            else:
-                print("Appending new statement metric")
-                per_statement_list.append(new_metric_item)
-            
-            # 4. Update the main statement_metrics object with the modified list
-            statement_metrics['perStatement'] = per_statement_list
-            
-            # 5. Save the entire updated statementMetrics object back to DynamoDB
-            table.update_item(
-                Key={'userId': user_id},
-                UpdateExpression="SET #sm = :new_metrics_object",
-                ExpressionAttributeNames={'#sm': 'statementMetrics'},
-                ExpressionAttributeValues={':new_metrics_object': statement_metrics}
+            s3_client.put_object(
+                Bucket=bucket,
+                Key=ledger_key,
+                Body=buffer,
+                ContentType='application/octet-stream',
+                **conditions
             )
-            print(f"Successfully saved analysis for user {user_id}.")
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+            return False
+    print(f"Saved ledger {ledger_key} with {len(ledger)} transactions.")
+    return True
+
+def update_user_ledger(bucket, user_id, statement_type, statement_id, chunks, source_token=None):
+    """
+    Merges a statement's transactions into the user's ledger and returns the
+    ledger metrics. The ledger is replaced with a conditional put, so concurrent
+    merges for the same user re-read the ledger and retry instead of losing rows.
+    """
+    ledger_key = ledger_key_for(user_id, statement_type)
+    for attempt in range(1, LEDGER_WRITE_ATTEMPTS + 1):
+        ledger, etag = load_ledger(bucket, ledger_key)
+        if source_token and ledger.sources.get(statement_id, {}).get('token') == source_token:
+            print(f"Ledger {ledger_key} already contains this version of {statement_id}.")
+            return ledger.metrics(ANALYSIS_WINDOWS_MONTHS)
+
+        merge = ledger.merge(chunks, statement_id, source_token)
+        print(f"Ledger merge for {statement_id}: {merge['added']} new, {merge['duplicates']} duplicate transactions. "
+              f"Months recomputed: {merge['affectedMonths']}")
+        ledger_metrics = ledger.metrics(ANALYSIS_WINDOWS_MONTHS)
+        ledger_metrics['lastMerge'] = merge
+
+        if write_ledger(bucket, ledger_key, ledger, etag):
+            return ledger_metrics
+        print(f"Ledger {ledger_key} changed concurrently (attempt {attempt}). Retrying.")
+
+    raise RuntimeError(f"Could not update ledger {ledger_key} after {LEDGER_WRITE_ATTEMPTS} attempts.")
+
+def load_user_ledgers(bucket, user_id):
+    """Reads every ledger a user has, keyed by statement type."""
+    ledgers = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=ledger_prefix_for(user_id)):
+        for obj in page.get('Contents', []):
+            statement_type = posixpath.splitext(posixpath.basename(obj['Key']))[0]
+            ledger, _ = load_ledger(bucket, obj['Key'])
+            if not ledger.stale:
+                ledgers[statement_type] = ledger
+    return ledgers
+
+def build_consolidated_metrics(bucket, user_id):
+    """
+    Rebuilds the user's consolidated view across statement types with own-account
+    transfers netted out. Returns None while the user has only one source.
+    """
+    ledgers = load_user_ledgers(bucket, user_id)
+    consolidated = consolidated_metrics(ledgers, ANALYSIS_WINDOWS_MONTHS)
+    if consolidated is None:
+        return None
+    print(f"Consolidated {consolidated['sources']} for user {user_id}: "
+          f"{consolidated['ownTransferCount']} own-account transfers netted.")
+    return consolidated
+
+# --- Persistence ---
+
+def get_profile_metrics(user_id, statement_types):
+    """
+    Reads the statementSummary of a user's profile plus the versions of the
+    ledgerMetrics entries for statement_types and of consolidatedMetrics.
+    """
+    names = {'#ss': 'statementSummary', '#lm': 'ledgerMetrics', '#cm': 'consolidatedMetrics', '#version': 'version'}
+    projection = ['#ss', '#cm.#version']
+    for index, statement_type in enumerate(statement_types):
+        names[f'#t{index}'] = statement_type
+        projection.append(f'#lm.#t{index}.#version')
+    response = get_profile_table().get_item(
+        Key={'userId': user_id},
+        ProjectionExpression=', '.join(projection),
+        ExpressionAttributeNames=names,
+        ConsistentRead=True
+    )
+    return response.get('Item', {})
+
+def ensure_ledger_metrics_map(user_id):
+    """
+    Creates an empty ledgerMetrics map on the profile when it has none, so entries
+    can be set by their nested path without replacing other statement types'.
+    An existing map is left as it is, which changes nothing and adds no stream record.
+    """
+    get_profile_table().update_item(
+        Key={'userId': user_id},
+        UpdateExpression='SET #lm = if_not_exists(#lm, :empty)',
+        ExpressionAttributeNames={'#lm': 'ledgerMetrics'},
+        ExpressionAttributeValues={':empty': {}}
+    )
+
+def put_statement_item(user_id, statement_id, metric_item):
+    """
+    Stores one statement's full metrics as its own item in the statement metrics
+    table. The profile only carries the compact statementSummary, so its writes and
+    stream images do not grow with every statement a user uploads.
+    """
+    get_statement_metrics_table().put_item(Item=dict(metric_item, userId=user_id, statementId=statement_id))
+
+def put_statement_items(user_id, metric_items):
+    """Stores several statements' metrics items with batched writes."""
+    with get_statement_metrics_table().batch_writer(overwrite_by_pkeys=['userId', 'statementId']) as batch:
+        for metric_item in metric_items:
+            batch.put_item(Item=dict(metric_item, userId=user_id, statementId=metric_item['id']))
+
+def save_profile_metrics(user_id, metric_items, ledger_metrics=None, consolidated=None):
+    """
+    Writes everything new statements change on the profile with one UpdateItem:
+    the statementSummary with metric_items folded in, ledgerMetrics.<statementType>
+    for each entry of ledger_metrics and consolidatedMetrics. One write is one
+    stream record, so the engine never scores a half-updated profile; a missing
+    ledgerMetrics map is created first by a write that carries no metrics. Ledger and
+    consolidated metrics older than the stored ones are left out. The update is
+    guarded by the summary's version, so a concurrent writer forces a re-read and
+    retry instead of a lost update.
+    """
+    ledger_metrics = ledger_metrics or {}
+    table = get_profile_table()
+    for attempt in range(1, SUMMARY_WRITE_ATTEMPTS + 1):
+        profile = get_profile_metrics(user_id, list(ledger_metrics))
+        previous_summary = profile.get('statementSummary')
+        summary = previous_summary
+        for metric_item in metric_items:
+            summary = build_statement_summary(summary, metric_item)
+
+        assignments = ['#ss = :summary']
+        names = {'#ss': 'statementSummary'}
+        values = {':summary': summary}
+
+        # Only the versions of these types are projected, so a map without them reads as missing too
+        stored_ledgers = profile.get('ledgerMetrics', {})
+        newer_ledgers = {
+            statement_type: metrics for statement_type, metrics in ledger_metrics.items()
+            if metrics['version'] > stored_ledgers.get(statement_type, {}).get('version', -1)
+        }
+        if newer_ledgers and not stored_ledgers:
+            # The nested path is invalid until the ledgerMetrics map exists
+            ensure_ledger_metrics_map(user_id)
+        for index, (statement_type, metrics) in enumerate(newer_ledgers.items()):
+            assignments.append(f'#lm.#t{index} = :lm{index}')
+            names['#lm'] = 'ledgerMetrics'
+            names[f'#t{index}'] = statement_type
+            values[f':lm{index}'] = metrics
+        skipped = set(ledger_metrics) - set(newer_ledgers)
+        if skipped:
+            print(f"Skipped ledgerMetrics for {sorted(skipped)} of user {user_id}: a newer ledger version is stored.")
+
+        stored_consolidated = profile.get('consolidatedMetrics')
+        if consolidated is not None:
+            if stored_consolidated is None or consolidated['version'] > stored_consolidated.get('version', -1):
+                assignments.append('#cm = :consolidated')
+                names['#cm'] = 'consolidatedMetrics'
+                values[':consolidated'] = consolidated
+            else:
+                print(f"Skipped consolidatedMetrics for user {user_id}: newer ledgers are already consolidated.")
+
+        update_args = {
+            'Key': {'userId': user_id},
+            'UpdateExpression': 'SET ' + ', '.join(assignments),
+            'ExpressionAttributeNames': names,
+            'ExpressionAttributeValues': values,
+        }
+        if previous_summary is None:
+            update_args['ConditionExpression'] = 'attribute_not_exists(#ss)'
+        else:
+            update_args['ConditionExpression'] = '#ss.#version = :expected_version'
+            names['#version'] = 'version'
+            values[':expected_version'] = previous_summary.get('version', 0)
 
+        try:
+            table.update_item(**update_args)
+            return summary
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            print(f"Profile metrics for user {user_id} changed concurrently (attempt {attempt}). Retrying.")
+
+    raise RuntimeError(f"Could not update profile metrics for user {user_id} after {SUMMARY_WRITE_ATTEMPTS} attempts.")
+
+# --- Record Processing ---
+
+def parse_statement_key(source_key):
+    """Splits processed/{statementType}/{userId}/{file} into its parts."""
+    parts = source_key.split('/')
+    if len(parts) < 3:
+        raise ValueError(f"Invalid S3 key format: {source_key}")
+    return parts[1], parts[2], os.path.basename(source_key)
+
+def build_metric_item(source_key, metrics_data):
+    """Wraps analyzer output in the per-statement metrics item."""
+    statement_type, _, file_name = parse_statement_key(source_key)
+    new_metric_item = {
+        'id': file_name, # Unique ID for the statement analysis
+        'sourceFile': source_key,
+        'statementType': statement_type,
+        'analysisDate': datetime.utcnow().isoformat()
+    }
+    new_metric_item.update(metrics_data)
+    return new_metric_item
+
+def process_record(record):
+    """Analyzes one S3 record and saves its metrics. Raises on failure."""
+    source_bucket = record['s3']['bucket']['name']
+    source_key = record['s3']['object']['key']
+    statement_type, user_id, file_name = parse_statement_key(source_key)
+
+    source_token = record['s3']['object'].get('eTag', '').strip('"')
+
+    print(f"Routing analysis for statement: {statement_type} for user: {user_id}")
+
+    # Set by the converter: identifies the PDF's content and the conversion the CSV came from
+    csv_metadata = read_csv_metadata(source_bucket, source_key) if get_statement_index() is not None else {}
+    digest = csv_metadata.get(CONTENT_HASH_METADATA)
+    generation = csv_metadata.get(GENERATION_METADATA)
+
+    # Replayed by the ledger merge (and its retries) without keeping the statement in memory
+    with ChunkSpool() as statement_chunks:
+        metrics_data = load_indexed_metrics(source_bucket, source_key, user_id, digest, generation, source_token, statement_chunks)
+        if metrics_data is None:
+            metrics_data = analyze_statement(source_bucket, source_key, statement_type, user_id, source_token, statement_chunks, generation)
+            index_statement_metrics(user_id, digest, generation, metrics_data)
+        new_metric_item = build_metric_item(source_key, metrics_data)
+
+        print(f"Analysis complete. Metrics: {new_metric_item}")
+
+        # --- Store the Statement's Own Metrics Item ---
+        put_statement_item(user_id, file_name, new_metric_item)
+
+        # --- Merge into the User's Transaction Ledger and Net Own-Account Transfers ---
+        ledger_metrics = {}
+        consolidated = None
+        try:
+            ledger_metrics[statement_type] = update_user_ledger(source_bucket, user_id, statement_type, file_name, statement_chunks, source_token)
+            consolidated = build_consolidated_metrics(source_bucket, user_id)
+        except Exception as e:
+            # The statement's own metrics still reach the profile; the record is reported as failed
+            # with the ledger error, even when this write fails too
+            print(f"ERROR merging {source_key} into the ledger of user {user_id}: {e}")
+            try:
+                save_profile_metrics(user_id, [new_metric_item], ledger_metrics)
+            except Exception as save_error:
+                print(f"ERROR saving the statement metrics of {source_key} after the ledger failure: {save_error}")
+            raise
+
+        # --- One Profile Write per Statement ---
+        save_profile_metrics(user_id, [new_metric_item], ledger_metrics, consolidated)
+        print(f"Successfully saved analysis for user {user_id}.")
+
+def process_user_records(records):
+    """Processes one user's records in order, isolating failures per record."""
+    failures = 0
+    for record in records:
+        try:
+            process_record(record)
         except Exception as e:
+            failures += 1
             print(f"ERROR processing record: {e}")
-            
+    return failures
+
+def group_records_by_user(records):
+    """Groups records by the user in their S3 key, keeping arrival order within each user."""
+    groups = OrderedDict()
+    for record in records:
+        try:
+            _, user_id, _ = parse_statement_key(record['s3']['object']['key'])
+        except Exception:
+            user_id = None # Let process_record report the malformed record
+        groups.setdefault(user_id, []).append(record)
+    return list(groups.values())
+
+# --- Main Lambda Handler (Router) ---
+
+def lambda_handler(event, context):
+    """
+    This Lambda is triggered by S3. It routes to the correct analysis function,
+    stores each statement's metrics as its own item and refreshes the profile's
+    statementSummary in DynamoDB.
+    Records for different users are processed concurrently; records for the
+    same user run one after another so they never race on the profile.
+    """
+    user_groups = group_records_by_user(event['Records'])
+
+    if len(user_groups) <= 1:
+        failures = sum(process_user_records(group) for group in user_groups)
+    else:
+        with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_USERS, len(user_groups))) as executor:
+            failures = sum(executor.map(process_user_records, user_groups))
+
+    if failures:
+        print(f"{failures} of {len(event['Records'])} records failed.")
+
     return {
         'statusCode': 200,
         'body': json.dumps('CSV analysis batch finished.')
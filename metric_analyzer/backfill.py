@@ -0,0 +1,294 @@
+"""
+Re-runs the statement analyzers over historical processed CSVs.
+
+Lists a processed-bucket prefix (or a local directory laid out the same way,
+e.g. DIR/processed/{statementType}/{userId}/{file}.csv), routes each file by its
+statementType key segment, analyzes the files in a process pool and writes the
+results per user with the same conflict-safe upserts the Lambda uses.
+
+    export PYTHONPATH=dependencies/statement_common/python  # the shared statements layer
+    python metric_analyzer/backfill.py --bucket finpay-dev-documents-processed-bucket --table finpay-dev-credit-profile-table \
+        --metrics-table finpay-dev-statement-metrics-table
+    python metric_analyzer/backfill.py --local-dir ./archive --output results.jsonl
+
+Each user's files are analyzed by one worker, so workers never race on a user's
+ledger. Completed files are appended to a checkpoint file, so an interrupted run
+can be restarted with the same arguments and only the remaining (or changed)
+files are analyzed again. In bucket mode each statement is also merged into the
+user's transaction ledger, which is written back once per statement type, and
+the newest ledger metrics are written with the results. With --output nothing is
+written to S3 or DynamoDB: ledgers are merged in memory only.
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import app
+from statements.ledger import ledger_key_for
+from statements.parsers import has_analyzer
+
+# --- Configuration ---
+DEFAULT_PREFIX = 'processed/'
+DEFAULT_CHECKPOINT = 'backfill-checkpoint.jsonl'
+PROGRESS_EVERY = 25 # Files between progress lines
+
+# --- Sources ---
+
+def list_bucket_files(bucket, prefix):
+    """Yields (key, token, size) for every CSV under the prefix. The token is the ETag."""
+    paginator = app.s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.csv'):
+                yield obj['Key'], obj['ETag'].strip('"'), obj['Size']
+
+def list_local_files(root, prefix):
+    """Local stand-in for list_bucket_files. Keys are paths relative to root."""
+    for directory, _, file_names in os.walk(root):
+        for file_name in sorted(file_names):
+            path = os.path.join(directory, file_name)
+            key = os.path.relpath(path, root).replace(os.sep, '/')
+            if key.startswith(prefix) and key.endswith('.csv'):
+                stat = os.stat(path)
+                yield key, f"{stat.st_mtime_ns}-{stat.st_size}", stat.st_size
+
+# --- Worker ---
+
+def merge_user_ledgers(bucket, user_id, statements, write_ledgers):
+    """
+    Merges a user's analyzed statements into their ledgers, one load and one
+    write per statement type. statements maps a statement type to a list of
+    (statement_id, token, chunks). Returns the ledger metrics per type. With
+    write_ledgers false the ledgers are only merged in memory.
+    """
+    ledger_metrics = {}
+    for statement_type, entries in statements.items():
+        ledger_key = ledger_key_for(user_id, statement_type)
+        for _ in range(app.LEDGER_WRITE_ATTEMPTS):
+            ledger, etag = app.load_ledger(bucket, ledger_key)
+            merge = None
+            for statement_id, token, chunks in entries:
+                if token and ledger.sources.get(statement_id, {}).get('token') == token:
+                    continue
+                merge = ledger.merge(chunks, statement_id, token)
+            if not write_ledgers or merge is None or app.write_ledger(bucket, ledger_key, ledger, etag):
+                break
+        else:
+            raise RuntimeError(f"Could not update ledger {ledger_key} after {app.LEDGER_WRITE_ATTEMPTS} attempts.")
+
+        metrics = ledger.metrics(app.ANALYSIS_WINDOWS_MONTHS)
+        if metrics is not None:
+            if merge is not None:
+                metrics['lastMerge'] = merge
+            ledger_metrics[statement_type] = metrics
+    return ledger_metrics
+
+def analyze_user(bucket, local_dir, user_id, files, write_ledgers):
+    """
+    Runs in a worker process and analyzes one user's files (a list of (key, token))
+    in order, so no two workers ever update the same user's ledgers. Returns
+    (user_id, results, ledger_metrics, ledger_error) where results holds
+    (key, metric_item, error) per file. Local files are not merged into ledgers.
+    With write_ledgers false (offline runs) nothing is written to S3: the columnar
+    cache is not used and ledgers are merged in memory. Analyzer logging is
+    discarded so the progress output stays readable.
+    """
+    results = []
+    statements = defaultdict(list)
+    ledger_metrics, ledger_error = {}, None
+    with contextlib.ExitStack() as spools, open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for key, token in files:
+            try:
+                statement_type, _, file_name = app.parse_statement_key(key)
+                if local_dir:
+                    with open(os.path.join(local_dir, key), encoding='utf-8-sig', newline='') as csv_file:
+                        metrics_data = app.analyze_chunks(app.iter_statement_chunks(statement_type, csv_file, user_id))
+                else:
+                    chunks = spools.enter_context(app.ChunkSpool())
+                    # Without a token analyze_statement neither reads nor saves the columnar cache
+                    cache_token = token if write_ledgers else None
+                    metrics_data = app.analyze_statement(bucket, key, statement_type, user_id, cache_token, chunks)
+                    statements[statement_type].append((file_name, token, chunks))
+                results.append((key, app.build_metric_item(key, metrics_data), None))
+            except Exception as e:
+                results.append((key, None, f"{type(e).__name__}: {e}"))
+
+        if statements:
+            try:
+                ledger_metrics = merge_user_ledgers(bucket, user_id, statements, write_ledgers)
+            except Exception as e:
+                ledger_error = f"{type(e).__name__}: {e}"
+    return user_id, results, ledger_metrics, ledger_error
+
+# --- Result Sinks ---
+
+class DynamoDBResultSink:
+    """
+    Writes a user's results with batched statement items and a single
+    conflict-safe profile update, the same one the Lambda makes per statement.
+    """
+
+    offline = False
+
+    def __init__(self, table_name, metrics_table_name, bucket=None):
+        app.DYNAMODB_TABLE = table_name
+        app.STATEMENT_METRICS_TABLE = metrics_table_name
+        self.bucket = bucket
+
+    def write_user(self, user_id, metric_items, ledger_metrics):
+        app.put_statement_items(user_id, metric_items)
+        consolidated = app.build_consolidated_metrics(self.bucket, user_id) if ledger_metrics and self.bucket else None
+        app.save_profile_metrics(user_id, metric_items, ledger_metrics, consolidated)
+
+
+class JsonLinesResultSink:
+    """
+    Offline stand-in for DynamoDBResultSink that appends one JSON line per
+    statement. Backfills into it leave S3 untouched as well.
+    """
+
+    offline = True
+
+    def __init__(self, path):
+        self.path = path
+
+    def write_user(self, user_id, metric_items, ledger_metrics):
+        with open(self.path, 'a') as output:
+            for metric_item in metric_items:
+                output.write(json.dumps({'userId': user_id, 'metrics': metric_item}, default=str) + '\n')
+            if ledger_metrics:
+                output.write(json.dumps({'userId': user_id, 'ledgerMetrics': ledger_metrics}, default=str) + '\n')
+
+# --- Checkpoints ---
+
+def load_checkpoint(path):
+    """Returns {key: token} for files completed by earlier runs."""
+    completed = {}
+    if path and os.path.exists(path):
+        with open(path) as checkpoint:
+            for line in checkpoint:
+                if line.strip():
+                    entry = json.loads(line)
+                    completed[entry['key']] = entry['token']
+    return completed
+
+def append_checkpoint(path, entries):
+    if not path or not entries:
+        return
+    with open(path, 'a') as checkpoint:
+        for key, token in entries:
+            checkpoint.write(json.dumps({'key': key, 'token': token}) + '\n')
+
+# --- Backfill ---
+
+def run_backfill(files, sink, bucket=None, local_dir=None, workers=None, checkpoint_path=None):
+    """
+    Analyzes files (an iterable of (key, token, size)) with one task per user and
+    writes each user's results once their files are done. Returns a summary dictionary.
+    """
+    started = time.monotonic()
+    completed = load_checkpoint(checkpoint_path)
+
+    files_per_user = defaultdict(list)
+    skipped = 0
+    total_bytes = 0
+    for key, token, size in files:
+        try:
+            statement_type, user_id, _ = app.parse_statement_key(key)
+        except ValueError:
+            skipped += 1
+            continue
+        if not has_analyzer(statement_type) or completed.get(key) == token:
+            skipped += 1
+            continue
+        files_per_user[user_id].append((key, token))
+        total_bytes += size
+
+    file_count = sum(len(user_files) for user_files in files_per_user.values())
+    token_by_key = {key: token for user_files in files_per_user.values() for key, token in user_files}
+    summary = {'files': file_count, 'skipped': skipped, 'succeeded': 0, 'failed': 0,
+               'usersWritten': 0, 'bytes': total_bytes}
+    print(f"Backfilling {file_count} files for {len(files_per_user)} users ({skipped} skipped).")
+
+    write_ledgers = bool(bucket) and not sink.offline
+    workers = workers or os.cpu_count() or 1
+    done = 0
+    reported = 0
+    # spawn keeps the workers from inheriting the parent's open boto3 connections
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(analyze_user, bucket, local_dir, user_id, user_files, write_ledgers)
+                   for user_id, user_files in files_per_user.items()]
+        for future in as_completed(futures):
+            user_id, results, ledger_metrics, ledger_error = future.result()
+            done += len(results)
+
+            succeeded = []
+            for key, metric_item, error in results:
+                error = error or ledger_error
+                if error:
+                    summary['failed'] += 1
+                    print(f"ERROR analyzing {key}: {error}")
+                else:
+                    succeeded.append((key, metric_item))
+
+            if succeeded:
+                try:
+                    sink.write_user(user_id, [item for _, item in succeeded], ledger_metrics)
+                    append_checkpoint(checkpoint_path, [(key, token_by_key[key]) for key, _ in succeeded])
+                    summary['succeeded'] += len(succeeded)
+                    summary['usersWritten'] += 1
+                except Exception as e:
+                    summary['failed'] += len(succeeded)
+                    print(f"ERROR writing results for user {user_id}: {e}")
+
+            if done - reported >= PROGRESS_EVERY or done == file_count:
+                reported = done
+                elapsed = time.monotonic() - started
+                print(f"Progress: {done}/{file_count} files, {summary['failed']} failed, {done / elapsed:.1f} files/s")
+
+    elapsed = time.monotonic() - started
+    summary['elapsedSeconds'] = round(elapsed, 2)
+    summary['filesPerSecond'] = round(done / elapsed, 2) if elapsed else 0.0
+    summary['megabytesPerSecond'] = round(summary['bytes'] / 1e6 / elapsed, 2) if elapsed else 0.0
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-run statement analysis over processed CSVs.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--bucket', help="Processed bucket to list.")
+    source.add_argument('--local-dir', help="Local directory laid out like the processed bucket.")
+    parser.add_argument('--prefix', default=DEFAULT_PREFIX, help="Key prefix to backfill (default: processed/).")
+    sink = parser.add_mutually_exclusive_group()
+    sink.add_argument('--table', default=os.environ.get('CREDIT_PROFILE_TABLE'), help="Credit profile table to update.")
+    sink.add_argument('--output', help="Write results to a JSON-lines file instead of DynamoDB.")
+    parser.add_argument('--metrics-table', default=os.environ.get('STATEMENT_METRICS_TABLE'),
+                        help="Statement metrics table that receives one item per statement.")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count).")
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT, help="Checkpoint file used to resume runs.")
+    args = parser.parse_args(argv)
+
+    if args.output:
+        result_sink = JsonLinesResultSink(args.output)
+    elif args.table and args.metrics_table:
+        result_sink = DynamoDBResultSink(args.table, args.metrics_table, args.bucket)
+    else:
+        parser.error("Either --table and --metrics-table (or CREDIT_PROFILE_TABLE and STATEMENT_METRICS_TABLE) or --output is required.")
+
+    if args.local_dir:
+        files = list_local_files(args.local_dir, args.prefix)
+    else:
+        files = list_bucket_files(args.bucket, args.prefix)
+
+    summary = run_backfill(files, result_sink, bucket=args.bucket, local_dir=args.local_dir,
+                           workers=args.workers, checkpoint_path=args.checkpoint)
+    print(f"Backfill summary: {json.dumps(summary)}")
+    return 1 if summary['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,20 +1,230 @@
 import json
 import boto3
+from botocore.exceptions import ClientError
 import os
 import csv
-from io import StringIO
+import multiprocessing
+import time
+import uuid
 import fitz  # PyMuPDF library
 
+from statements.columnar import GENERATION_METADATA, ColumnarWriter, columnar_key_for
+from statements.dedup import CONTENT_HASH_METADATA, DynamoDBStatementIndex, content_hash
+from statements.parsers import has_analyzer, parse_statement_rows
+from checkpoints import CheckpointSaved, ExtractionCheckpoint, LocalPartStore, S3PartStore
+from fanout import (
+    RANGE_TASK,
+    DynamoDBJobTracker,
+    InMemoryJobTracker,
+    LocalTaskQueue,
+    SqsTaskQueue,
+    job_complete,
+    plan_ranges,
+    range_task_body,
+)
+from layouts import LayoutExtractor, LayoutMatch
+from uploads import LocalUpload, S3MultipartUpload
+
 # --- Configuration ---
 DESTINATION_BUCKET = os.environ.get('CSV_DESTINATION_BUCKET')
+PARALLEL_MIN_PAGES = int(os.environ.get('PARALLEL_MIN_PAGES', '40')) # Smaller documents are extracted in-process
+MAX_EXTRACTION_WORKERS = int(os.environ.get('MAX_EXTRACTION_WORKERS', '0')) # 0 uses every available CPU
+MAX_PDF_BYTES = int(os.environ.get('MAX_PDF_BYTES', str(100 * 1024 * 1024))) # Statements are read fully into memory
+# Fused mode: also parse the extracted rows into typed transactions and write the
+# columnar file the analyzer reads, so it never has to parse the CSV
+FUSED_TRANSACTIONS = os.environ.get('FUSED_TRANSACTIONS', 'false').lower() == 'true'
+LAYOUT_TEMPLATES_ENABLED = os.environ.get('LAYOUT_TEMPLATES_ENABLED', 'true').lower() == 'true'
+LOCAL_OUTPUT_DIR = os.environ.get('LOCAL_OUTPUT_DIR') # When set, outputs are written here instead of S3
+STATEMENT_INDEX_TABLE = os.environ.get('STATEMENT_INDEX_TABLE') # Content-hash index; unset disables deduplication
+# Time a batch must have left to start converting another message; the rest go back to the queue
+MESSAGE_TIME_RESERVE_MS = int(os.environ.get('MESSAGE_TIME_RESERVE_SECONDS', '60')) * 1000
+# Extraction runs in rounds of this many pages per worker, and every round but the last is checkpointed
+CHECKPOINT_PAGES = int(os.environ.get('CHECKPOINT_PAGES', '50'))
+# Time kept free after the last round to save it and hand the message back
+CHECKPOINT_RESERVE_MS = int(os.environ.get('CHECKPOINT_RESERVE_SECONDS', '15')) * 1000
+# Assumed extraction time per page and worker until a round has been timed in this container
+PAGE_TIME_ESTIMATE_MS = int(os.environ.get('PAGE_TIME_ESTIMATE_MS', '500'))
+CONVERSION_QUEUE_URL = os.environ.get('CONVERSION_QUEUE_URL') # Paused conversions and page-range tasks are sent here
+# Split mode: documents this long are extracted by range tasks in separate invocations and merged
+FANOUT_MIN_PAGES = int(os.environ.get('FANOUT_MIN_PAGES', '1000'))
+FANOUT_PAGES = int(os.environ.get('FANOUT_PAGES', '200')) # Pages per range task; must extract well within the timeout
+CONVERSION_JOB_TABLE = os.environ.get('CONVERSION_JOB_TABLE') # Completion counters of split conversions
 
 
 # --- AWS Client Initialization ---
 s3_client = boto3.client('s3')
+sqs_client = boto3.client('sqs')
+# Tests and local runs can swap in statements.dedup.InMemoryStatementIndex
+statement_index = DynamoDBStatementIndex(boto3.resource('dynamodb').Table(STATEMENT_INDEX_TABLE)) if STATEMENT_INDEX_TABLE else None
+# Local runs (LOCAL_OUTPUT_DIR) get in-process stand-ins; task_queue.run(lambda_handler) works off the queue
+if CONVERSION_QUEUE_URL:
+    task_queue = SqsTaskQueue(sqs_client, CONVERSION_QUEUE_URL)
+else:
+    task_queue = LocalTaskQueue() if LOCAL_OUTPUT_DIR else None
+if CONVERSION_JOB_TABLE:
+    job_tracker = DynamoDBJobTracker(boto3.resource('dynamodb').Table(CONVERSION_JOB_TABLE))
+else:
+    job_tracker = InMemoryJobTracker() if LOCAL_OUTPUT_DIR else None
+# Measured time per page and worker of the last extraction round, kept across messages
+last_page_time_ms = None
+
+# --- Page Analysis Cache ---
+
+class TemplateTable:
+    """Rows extracted with a layout template, shaped like a find_tables() table."""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def extract(self):
+        return self.rows
+
+
+class PageAnalysis:
+    """
+    Runs table detection at most once per page. find_tables() is the most
+    expensive call we make, so validation and extraction share its results.
+    Pages are only analyzed when first asked for. Known provider layouts are
+    read from the page's words first (see layouts.py), and find_tables() only
+    runs on pages no template confidently matches.
+    """
+
+    def __init__(self, doc, statement_type=None, layout_match=None):
+        self.doc = doc
+        self._tables = {}
+        self.layouts = None
+        if LAYOUT_TEMPLATES_ENABLED and statement_type:
+            self.layouts = LayoutExtractor(statement_type, layout_match)
+        self.template_pages = 0
+
+    @property
+    def page_count(self):
+        return self.doc.page_count
+
+    @property
+    def analyzed_pages(self):
+        """Number of leading pages whose tables are already cached."""
+        count = 0
+        while count in self._tables:
+            count += 1
+        return count
+
+    def tables(self, page_num):
+        """Returns the tables detected on a page."""
+        if page_num not in self._tables:
+            page = self.doc[page_num]
+            rows = self.layouts.extract(page) if self.layouts else None
+            if rows:
+                self.template_pages += 1
+                self._tables[page_num] = [TemplateTable(rows)]
+            else:
+                self._tables[page_num] = page.find_tables().tables
+        return self._tables[page_num]
+
+    def release(self, page_num):
+        """Drops a page's cached tables once its rows have been extracted."""
+        self._tables[page_num] = []
+
+    @property
+    def layout_match(self):
+        """The last template match, which workers continue from."""
+        return self.layouts.match if self.layouts else None
+
+# --- Table Extraction ---
+
+def iter_page_rows(analysis, page_nums):
+    """Yields the CSV rows of the tables on the given pages in page order, releasing each page once read."""
+    for page_num in page_nums:
+        tables = analysis.tables(page_num)
+        if tables:
+            if page_num > 0:
+                yield [f"--- Page {page_num + 1} ---"]
+            for table in tables:
+                table_data = table.extract()
+                if table_data:
+                    yield from table_data
+                    yield []
+        analysis.release(page_num)
+
+def open_pdf(pdf_bytes):
+    return fitz.open(stream=pdf_bytes, filetype="pdf")
+
+def extract_range_worker(statement_type, layout_match, start, stop, connection):
+    """
+    Worker process: receives the document's bytes over its connection, opens them
+    in memory and sends back the rows of pages [start, stop).
+    """
+    try:
+        doc = open_pdf(connection.recv_bytes())
+        layout_match = LayoutMatch.from_dict(layout_match) if layout_match else None
+        analysis = PageAnalysis(doc, statement_type, layout_match)
+        connection.send(('ok', list(iter_page_rows(analysis, range(start, stop)))))
+    except Exception as e:
+        connection.send(('error', f"pages {start + 1}-{stop}: {e}"))
+    finally:
+        connection.close()
+
+def extraction_worker_count():
+    """Number of worker processes to use, from the CPUs this process may run on."""
+    available = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    return min(available, MAX_EXTRACTION_WORKERS) if MAX_EXTRACTION_WORKERS > 0 else available
+
+def extraction_context():
+    """
+    The multiprocessing context for extraction workers. Forking this process is
+    unsafe once the upload threads run (they may hold boto3's or logging's locks),
+    so workers are forked from a forkserver started from a clean interpreter,
+    which has this module preloaded to keep each start cheap.
+    """
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload([__name__])
+    return context
+
+def extract_rows_parallel(pdf_bytes, analysis, statement_type, start, stop, workers):
+    """
+    Splits pages [start, stop) into one contiguous range per worker process and
+    yields the results in page order, one range at a time. Uses a Process and Pipe
+    per worker, since Lambda has no /dev/shm for multiprocessing.Pool, Queue or
+    shared memory. Each worker is sent the PDF's bytes over its pipe and opens
+    them from memory, so nothing is written to /tmp.
+    """
+    context = extraction_context()
+    layout_match = analysis.layout_match.to_dict() if analysis.layout_match else None
+    bounds = [start + (stop - start) * i // workers for i in range(workers + 1)]
+    jobs = []
+    try:
+        for range_start, range_stop in zip(bounds, bounds[1:]):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=extract_range_worker, args=(statement_type, layout_match, range_start, range_stop, worker_connection))
+            process.start()
+            worker_connection.close()
+            jobs.append((process, connection))
+
+        for process, connection in jobs:
+            # Every worker reads the document first, so these sends never wait on a result
+            connection.send_bytes(pdf_bytes)
+
+        for process, connection in jobs:
+            # Receive before joining: a worker blocks on send until its rows are read
+            try:
+                status, result = connection.recv()
+            except EOFError:
+                status, result = 'error', "worker exited without sending results"
+            process.join()
+            if status != 'ok':
+                raise RuntimeError(f"Parallel table extraction failed: {result}")
+            yield from result
+    finally:
+        # Stops the remaining workers when extraction failed or the caller gave up
+        for process, connection in jobs:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+            connection.close()
 
 # --- Validation and Fraud Detection Functions ---
 
-def perform_common_validation(doc):
+def perform_common_validation(doc, analysis):
     """
     Performs universal checks that apply to all statement types.
     This runs before any provider-specific validation.
@@ -22,7 +232,8 @@ def perform_common_validation(doc):
     if doc.page_count == 0:
         raise ValueError("Validation FAIL: PDF document has no pages.")
     
-    has_tables = any(page.find_tables().tables for page in doc)
+    # Stops at the first page with a table; the pages it analyzed are reused for extraction
+    has_tables = any(analysis.tables(page_num) for page_num in range(analysis.page_count))
     if not has_tables:
         raise ValueError("Validation FAIL: No tables were found in the document.")
     
@@ -47,90 +258,432 @@ def validate_mtn_momo_statement(doc, user_id_from_key):
 
 # --- Main Processing Logic ---
 
-def handle_statement(local_pdf_path, statement_type, user_id):
+def handle_statement(pdf_bytes, statement_type, user_id, checkpoint=None, remaining_ms=None):
     """
     Main processing function that runs a multi-step validation process
-    before converting the document.
+    before converting the document. Returns an iterator over the table rows,
+    which extracts the pages as it is consumed (see iter_statement_rows for
+    checkpoint and remaining_ms).
     """
-    doc = fitz.open(local_pdf_path)
+    analysis = validate_statement(pdf_bytes, statement_type, user_id)
+    return iter_statement_rows(pdf_bytes, analysis, statement_type, checkpoint, remaining_ms)
+
+def validate_statement(pdf_bytes, statement_type, user_id):
+    """Opens a statement and runs the validation steps. Returns its PageAnalysis."""
+    doc = open_pdf(pdf_bytes)
+    analysis = PageAnalysis(doc, statement_type)
     
-    perform_common_validation(doc)
+    perform_common_validation(doc, analysis)
 
     #if statement_type == 'momo-mtn-statement':
     #    validate_mtn_momo_statement(doc, user_id)
     #else:
     #    print(f"No specific validator for statement type '{statement_type}'. Skipping specific validation.")
 
-    all_table_data = []
-    for page_num, page in enumerate(doc):
-        table_objects = page.find_tables()
-        if table_objects.tables:
-            if page_num > 0:
-                all_table_data.append([f"--- Page {page_num + 1} ---"])
-            for table in table_objects.tables:
-                table_data = table.extract()
-                if table_data:
-                    all_table_data.extend(table_data)
-                    all_table_data.append([]) 
+    return analysis
+
+def iter_round_rows(pdf_bytes, analysis, statement_type, start, stop, workers):
+    """Yields the rows of pages [start, stop): cached pages in-process, the rest across workers when there are several."""
+    # Pages analyzed during validation are already cached, so only the rest are split up
+    cached_stop = min(max(analysis.analyzed_pages, start), stop)
+    yield from iter_page_rows(analysis, range(start, cached_stop))
+    workers = min(workers, stop - cached_stop)
+    if workers > 1:
+        yield from extract_rows_parallel(pdf_bytes, analysis, statement_type, cached_stop, stop, workers)
+    else:
+        yield from iter_page_rows(analysis, range(cached_stop, stop))
+
+def iter_statement_rows(pdf_bytes, analysis, statement_type, checkpoint=None, remaining_ms=None):
+    """
+    Yields every table row of a validated document, in page order. With a
+    checkpoint, pages saved by earlier attempts are read back instead of
+    extracted, and the rest is extracted in rounds of up to CHECKPOINT_PAGES
+    pages per worker, each saved before the next starts. remaining_ms (the Lambda
+    context's get_remaining_time_in_millis) bounds the work: every round,
+    including the first, is cut to the pages that fit in the time left at the
+    last measured time per page, and CheckpointSaved is raised when not even one
+    page per worker fits. The first round of an attempt always extracts at least
+    one page per worker while time beyond the reserve is left.
+    """
+    global last_page_time_ms
+    page_count = analysis.page_count
+    start = 0
+    if checkpoint is not None and checkpoint.pages_done:
+        start = min(checkpoint.pages_done, page_count)
+        print(f"Resuming extraction at page {start + 1} of {page_count} from checkpoint.")
+        yield from checkpoint.iter_saved_rows()
+
+    remaining_pages = page_count - max(analysis.analyzed_pages, start)
+    workers = min(extraction_worker_count(), remaining_pages)
+    if remaining_pages >= PARALLEL_MIN_PAGES and workers > 1:
+        print(f"Extracting {remaining_pages} pages with {workers} worker processes.")
+    else:
+        workers = 1
+    round_pages = CHECKPOINT_PAGES * workers if checkpoint is not None else page_count
+    timed = checkpoint is not None and remaining_ms is not None
+
+    round_start = first_round_start = start
+    while round_start < page_count:
+        round_stop = min(round_start + round_pages, page_count)
+        if timed:
+            budget_ms = remaining_ms() - CHECKPOINT_RESERVE_MS
+            fitting_pages = int(budget_ms // (last_page_time_ms or PAGE_TIME_ESTIMATE_MS))
+            if fitting_pages < 1:
+                # A small round's time is mostly worker start-up, so the first round of an
+                # attempt gets one page per worker anyway rather than stalling the conversion
+                if round_start > first_round_start or budget_ms <= 0:
+                    raise CheckpointSaved(round_start, page_count)
+                fitting_pages = 1
+            round_stop = min(round_stop, round_start + fitting_pages * workers)
+        began = time.monotonic()
+        rows = iter_round_rows(pdf_bytes, analysis, statement_type, round_start, round_stop, workers)
+        if checkpoint is None or round_stop == page_count:
+            yield from rows
+        else:
+            saved = []
+            for row in rows:
+                saved.append(row)
+                yield row
+            checkpoint.save(round_start, round_stop, saved)
+        pages_per_worker = -(-(round_stop - round_start) // workers)
+        last_page_time_ms = (time.monotonic() - began) * 1000 / pages_per_worker
+        round_start = round_stop
+    if workers == 1:
+        print(f"Layout templates extracted {analysis.template_pages} of {page_count - start} pages.")
+
+# --- Output ---
+
+def open_output(key, content_type, metadata=None):
+    """Opens a streaming upload into the destination bucket, or a local file when LOCAL_OUTPUT_DIR is set."""
+    if LOCAL_OUTPUT_DIR:
+        return LocalUpload(LOCAL_OUTPUT_DIR, key, content_type, metadata)
+    return S3MultipartUpload(s3_client, DESTINATION_BUCKET, key, content_type, metadata)
+
+
+class CsvRowWriter:
+    """
+    Passes rows through while writing them to a CSV stream, so the CSV uploads
+    while another consumer (the fused parser) reads the same rows. drain() writes
+    whatever the consumer left unread. An error raised by the row source is kept
+    in error and raised again by drain().
+    """
+
+    def __init__(self, rows, stream):
+        self.rows = iter(rows)
+        self.writer = csv.writer(stream)
+        self.error = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.error is not None:
+            raise StopIteration
+        try:
+            row = next(self.rows)
+        except StopIteration:
+            raise
+        except Exception as e:
+            self.error = e
+            raise
+        self.writer.writerow(row)
+        return row
+
+    def drain(self):
+        for _ in self:
+            pass
+        if self.error is not None:
+            raise self.error
+
+
+def write_transactions(rows, statement_type, user_id, csv_key, generation):
+    """
+    Fused mode: parses the extracted rows with the analyzer's parsers and uploads
+    the transactions as the columnar file beside the CSV. Returns the row count.
+    """
+    # Empty cells come back from extract() as None; the CSV round trip makes them ''
+    cells = ([value if value is not None else '' for value in row] for row in rows)
+    with open_output(columnar_key_for(csv_key), 'application/octet-stream') as output:
+        writer = ColumnarWriter(output, {
+            'sourceKey': csv_key,
+            'generation': generation,
+            'statementType': statement_type,
+        })
+        for chunk in parse_statement_rows(statement_type, cells, user_id):
+            writer.write_chunk(chunk)
+    return writer.row_count
 
-    string_io = StringIO()
-    writer = csv.writer(string_io)
-    writer.writerows(all_table_data)
-    return string_io.getvalue()
 
+def read_statement_pdf(bucket, key):
+    """Reads an uploaded statement into memory, refusing files larger than MAX_PDF_BYTES."""
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    if response['ContentLength'] > MAX_PDF_BYTES:
+        response['Body'].close()
+        raise ValueError(f"Statement is {response['ContentLength']} bytes; the limit is {MAX_PDF_BYTES}.")
+    return response['Body'].read()
+
+
+# --- Deduplication ---
+
+def reuse_conversion(user_id, digest, statement_type, output_key):
+    """
+    Publishes the user's earlier conversion of the same PDF instead of extracting it
+    again. The index is kept per user, so another user's identical upload is converted anew.
+    Re-uploads under another name get a server-side copy of the earlier CSV (and its
+    columnar file); re-deliveries of an already converted upload need nothing.
+    Returns True when the statement needs no conversion.
+    """
+    if statement_index is None or LOCAL_OUTPUT_DIR:
+        return False
+    entry = statement_index.get(user_id, digest)
+    if not entry or entry.get('statementType') != statement_type:
+        return False
+
+    previous_key = entry['csvKey']
+    try:
+        response = s3_client.head_object(Bucket=DESTINATION_BUCKET, Key=previous_key)
+    except ClientError:
+        print(f"Indexed conversion {previous_key} is gone; converting again.")
+        return False
+    if response.get('Metadata', {}).get(GENERATION_METADATA) != entry['generation']:
+        # The CSV was overwritten by another conversion since it was indexed
+        return False
+
+    if previous_key == output_key:
+        print(f"{output_key} is already a conversion of this document; skipping extraction.")
+        return True
+
+    # The columnar file goes first: the CSV triggers the analyzer, which looks for it
+    try:
+        s3_client.copy_object(
+            Bucket=DESTINATION_BUCKET,
+            Key=columnar_key_for(output_key),
+            CopySource={'Bucket': DESTINATION_BUCKET, 'Key': columnar_key_for(previous_key)}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+    # Metadata is copied too, so the copy keeps the generation of the original conversion
+    s3_client.copy_object(
+        Bucket=DESTINATION_BUCKET,
+        Key=output_key,
+        CopySource={'Bucket': DESTINATION_BUCKET, 'Key': previous_key}
+    )
+    print(f"Identical document already converted; copied {previous_key} to {output_key}.")
+    return True
+
+
+# --- Publishing ---
+
+def open_checkpoint(output_key, digest):
+    """The extraction checkpoint of a document, in the destination bucket or under LOCAL_OUTPUT_DIR."""
+    store = LocalPartStore(LOCAL_OUTPUT_DIR) if LOCAL_OUTPUT_DIR else S3PartStore(s3_client, DESTINATION_BUCKET)
+    return ExtractionCheckpoint(store, output_key, digest)
+
+def publish_conversion(table_rows, statement_type, user_id, output_key, digest, source_key, checkpoint, generation=None):
+    """Writes the rows as the statement's CSV (and, in fused mode, its transactions), then indexes the conversion."""
+    fused = FUSED_TRANSACTIONS and has_analyzer(statement_type)
+    # Identifies this conversion; copies of the CSV keep it (see reuse_conversion)
+    generation = generation or uuid.uuid4().hex
+    metadata = {GENERATION_METADATA: generation, CONTENT_HASH_METADATA: digest}
+    # The CSV is streamed up while pages are extracted and only published at the end
+    with open_output(output_key, 'text/csv', metadata) as csv_output:
+        csv_rows = CsvRowWriter(table_rows, csv_output)
+        if fused:
+            # Finished before the CSV is published, since the CSV triggers the analyzer
+            try:
+                row_count = write_transactions(csv_rows, statement_type, user_id, output_key, generation)
+                print(f"Wrote {row_count} typed transactions beside {output_key}")
+            except Exception as e:
+                if csv_rows.error is not None:
+                    raise
+                # The analyzer finds no matching .txc and parses the CSV, which reports the error properly
+                print(f"Warning: could not write transactions for {output_key}: {e}")
+        csv_rows.drain()
+    print(f"Successfully validated and uploaded {csv_output.bytes_written} bytes of CSV to: {output_key}")
+    checkpoint.clear()
+
+    if statement_index is not None:
+        try:
+            statement_index.record_conversion(user_id, digest, statement_type, output_key, generation, source_key)
+        except Exception as e:
+            # The CSV is published; a missing entry only costs a full conversion next time
+            print(f"Warning: could not index conversion {output_key}: {e}")
+
+# --- Split Conversion ---
+
+def start_split_conversion(analysis, checkpoint, job):
+    """
+    Coordinator: when a document is too long for one invocation, enqueues a task
+    per FANOUT_PAGES-page range of the pages not yet checkpointed and returns True.
+    job holds the fields every task needs. The worker that finishes the last range
+    merges them (see process_range_task).
+    """
+    if task_queue is None or job_tracker is None or analysis.page_count < FANOUT_MIN_PAGES:
+        return False
+    if analysis.page_count - checkpoint.pages_done <= FANOUT_PAGES:
+        return False
+
+    ranges = plan_ranges(checkpoint.pages_done, analysis.page_count, FANOUT_PAGES)
+    layout_match = analysis.layout_match
+    job = dict(
+        job,
+        jobId=uuid.uuid4().hex,
+        pageCount=analysis.page_count,
+        partCount=len(ranges),
+        layoutMatch=layout_match.to_dict() if layout_match else None,
+    )
+    job_tracker.start(job['jobId'], len(ranges))
+    task_queue.send_all([range_task_body(job, part, start, stop) for part, (start, stop) in enumerate(ranges)])
+    print(f"Split {job['sourceKey']} into {len(ranges)} range tasks of up to {FANOUT_PAGES} pages (job {job['jobId']}).")
+    return True
+
+def process_range_task(task):
+    """
+    Worker: extracts one page range of a split conversion into its checkpoint
+    part and counts it as done. The worker that completes the count merges all
+    parts in page order and publishes the CSV. Re-delivered tasks reuse their part.
+    """
+    job = job_tracker.get(task['jobId'])
+    if job is None or job.get('mergedAt'):
+        # Re-delivered after the merge, or the job expired
+        print(f"Job {task['jobId']} is already finished; skipping pages {task['start'] + 1}-{task['stop']}.")
+        return
+
+    checkpoint = open_checkpoint(task['outputKey'], task['contentHash'])
+    start, stop = task['start'], task['stop']
+    if checkpoint.has_part(start, stop):
+        print(f"Pages {start + 1}-{stop} of {task['sourceKey']} are already extracted.")
+    else:
+        pdf_bytes = read_statement_pdf(task['sourceBucket'], task['sourceKey'])
+        layout_match = LayoutMatch.from_dict(task['layoutMatch']) if task.get('layoutMatch') else None
+        analysis = PageAnalysis(open_pdf(pdf_bytes), task['statementType'], layout_match)
+        workers = extraction_worker_count() if stop - start >= PARALLEL_MIN_PAGES else 1
+        rows = list(iter_round_rows(pdf_bytes, analysis, task['statementType'], start, stop, workers))
+        checkpoint.save(start, stop, rows)
+
+    job = job_tracker.complete_part(task['jobId'], task['part'])
+    print(f"Job {task['jobId']}: {len(job.get('partsDone', ()))} of {job['partCount']} ranges extracted.")
+    if not job_complete(job) or job.get('mergedAt'):
+        return
+
+    if checkpoint.load() < task['pageCount']:
+        raise RuntimeError(f"Job {task['jobId']} has no part for pages after {checkpoint.pages_done}.")
+    print(f"Merging {len(checkpoint.parts)} parts of {task['sourceKey']}.")
+    publish_conversion(
+        checkpoint.iter_saved_rows(), task['statementType'], task['userId'], task['outputKey'],
+        task['contentHash'], task['sourceKey'], checkpoint, generation=task['jobId']
+    )
+    job_tracker.mark_merged(task['jobId'])
+
+# --- Message Processing ---
+
+def process_message(record, context=None):
+    """
+    Converts the statement named in one SQS message, or runs a page-range task of
+    a split conversion. Raises on failure, and CheckpointSaved when the conversion
+    paused to stay within the invocation's time.
+    """
+    sqs_body = json.loads(record['body'])
+    if sqs_body.get('task') == RANGE_TASK:
+        process_range_task(sqs_body)
+        return
+
+    s3_info = sqs_body['Records'][0]['s3']
+    source_bucket = s3_info['bucket']['name']
+    source_key = s3_info['object']['key']
+
+    parts = source_key.split('/')
+    if len(parts) < 4:
+        raise ValueError(f"Invalid S3 key format: {source_key}")
+
+    statement_type = parts[1]
+    user_id = parts[2]
+
+    print(f"Processing {statement_type} for user {user_id} from s3://{source_bucket}/{source_key}")
+
+    pdf_bytes = read_statement_pdf(source_bucket, source_key)
+    output_key = f"processed/{statement_type}/{user_id}/{os.path.splitext(os.path.basename(source_key))[0]}.csv"
+    digest = content_hash(pdf_bytes)
+    if reuse_conversion(user_id, digest, statement_type, output_key):
+        return
+
+    checkpoint = open_checkpoint(output_key, digest)
+    checkpoint.load()
+    analysis = validate_statement(pdf_bytes, statement_type, user_id)
+    job = {
+        'sourceBucket': source_bucket,
+        'sourceKey': source_key,
+        'statementType': statement_type,
+        'userId': user_id,
+        'outputKey': output_key,
+        'contentHash': digest,
+    }
+    if start_split_conversion(analysis, checkpoint, job):
+        return
+
+    remaining_ms = context.get_remaining_time_in_millis if context is not None else None
+    table_rows = iter_statement_rows(pdf_bytes, analysis, statement_type, checkpoint, remaining_ms)
+    publish_conversion(table_rows, statement_type, user_id, output_key, digest, source_key, checkpoint)
+
+def requeue_message(record):
+    """
+    Sends a paused or deferred conversion back to the queue as a new message, so
+    continuing it does not count towards the DLQ's receive limit. Returns False
+    when that is not possible and the message has to be retried instead.
+    """
+    if task_queue is None:
+        return False
+    try:
+        task_queue.send(record['body'])
+        return True
+    except Exception as e:
+        print(f"Warning: could not re-enqueue {message_key(record)}: {e}")
+        return False
+
+def message_key(record):
+    """The uploaded object's key (and pages, for range tasks), for log lines; '' when the message is malformed."""
+    try:
+        body = json.loads(record['body'])
+        if body.get('task') == RANGE_TASK:
+            return f"{body['sourceKey']} pages {body['start'] + 1}-{body['stop']}"
+        return body['Records'][0]['s3']['object']['key']
+    except Exception:
+        return ''
 
 # --- Main Lambda Handler ---
 
 def lambda_handler(event, context):
     """
-    This Lambda is triggered by SQS. It parses the S3 key to determine the
-    statement type, performs validation, and then converts the PDF to CSV.
-    If it fails, it raises an exception to let SQS handle the retry/DLQ process.
+    This Lambda is triggered by SQS. For each message it parses the S3 key to
+    determine the statement type, performs validation, and then converts the PDF
+    to CSV. Messages are isolated from each other: failed ones are reported in
+    batchItemFailures, so SQS retries (and eventually dead-letters) only those,
+    while clients, templates and PyMuPDF's caches stay warm across the batch.
     """
-    if not DESTINATION_BUCKET:
+    if not DESTINATION_BUCKET and not LOCAL_OUTPUT_DIR:
         raise ValueError("Destination S3 bucket not configured.")
 
+    failures = []
     for record in event['Records']:
-        source_bucket, source_key, local_pdf_path = "", "", ""
+        if context is not None and context.get_remaining_time_in_millis() < MESSAGE_TIME_RESERVE_MS:
+            # Too close to the timeout to start another statement. It was never attempted,
+            # so it goes back as a new message rather than as a failed receive
+            print(f"Deferring {message_key(record)}: not enough time left in this invocation.")
+            if not requeue_message(record):
+                failures.append({'itemIdentifier': record['messageId']})
+            continue
         try:
-            sqs_body = json.loads(record['body'])
-            s3_info = sqs_body['Records'][0]['s3']
-            source_bucket = s3_info['bucket']['name']
-            source_key = s3_info['object']['key']
-
-            parts = source_key.split('/')
-            if len(parts) < 4:
-                raise ValueError(f"Invalid S3 key format: {source_key}")
-            
-            statement_type = parts[1]
-            user_id = parts[2]
-            
-            print(f"Processing {statement_type} for user {user_id} from s3://{source_bucket}/{source_key}")
-
-            local_pdf_path = f"/tmp/{os.path.basename(source_key)}"
-            s3_client.download_file(source_bucket, source_key, local_pdf_path)
-            
-            final_csv_content = handle_statement(local_pdf_path, statement_type, user_id)
-
-            output_key = f"processed/{statement_type}/{user_id}/{os.path.splitext(os.path.basename(source_key))[0]}.csv"
-            s3_client.put_object(
-                Bucket=DESTINATION_BUCKET,
-                Key=output_key,
-                Body=final_csv_content,
-                ContentType='text/csv'
-            )
-            print(f"Successfully validated and uploaded CSV to: s3://{DESTINATION_BUCKET}/{output_key}")
-            
+            process_message(record, context)
+        except CheckpointSaved as e:
+            # Every attempt extracts at least one round, so a re-sent conversion always finishes
+            print(f"{message_key(record)}: {e}")
+            if not requeue_message(record):
+                failures.append({'itemIdentifier': record['messageId']})
         except Exception as e:
-            
-            print(f"ERROR: Failed to process {source_key}. Reason: {str(e)}")
-            raise e
-        
-        finally:
-            if local_pdf_path and os.path.exists(local_pdf_path):
-                os.remove(local_pdf_path)
-            
-    return {
-        'statusCode': 200,
-        'body': json.dumps('PDF processing batch finished successfully.')
-    }
+            print(f"ERROR: Failed to process {message_key(record)}. Reason: {str(e)}")
+            failures.append({'itemIdentifier': record['messageId']})
+
+    if failures:
+        print(f"{len(failures)} of {len(event['Records'])} messages were not converted.")
+    return {'batchItemFailures': failures}
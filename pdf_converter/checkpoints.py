@@ -0,0 +1,151 @@
+import csv
+import io
+import os
+import re
+
+from botocore.exceptions import ClientError
+
+# --- Configuration ---
+CHECKPOINT_PREFIX = 'checkpoints' # Outside processed/, and .csvpart never matches the analyzer's .csv trigger
+PART_PATTERN = re.compile(r'(\d+)-(\d+)\.csvpart$')
+
+
+class CheckpointSaved(Exception):
+    """Extraction stopped early to stay within the time budget; pages before next_page are saved."""
+
+    def __init__(self, next_page, page_count):
+        super().__init__(f"Extraction paused after page {next_page} of {page_count}; progress is checkpointed.")
+        self.next_page = next_page
+        self.page_count = page_count
+
+# --- Part Storage ---
+
+class S3PartStore:
+    """Checkpoint parts as objects in a bucket."""
+
+    def __init__(self, s3_client, bucket):
+        self.s3_client = s3_client
+        self.bucket = bucket
+
+    def list_keys(self, prefix):
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key']
+
+    def read(self, key):
+        body = self.s3_client.get_object(Bucket=self.bucket, Key=key)['Body']
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+    def write(self, key, data):
+        self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType='text/csv')
+
+    def exists(self, key):
+        try:
+            self.s3_client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError:
+            return False
+
+    def delete(self, keys):
+        try:
+            self.s3_client.delete_objects(
+                Bucket=self.bucket,
+                Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+            )
+        except ClientError as e:
+            # Left-over parts expire through the bucket's lifecycle rule
+            print(f"Warning: could not delete checkpoint parts: {e}")
+
+
+class LocalPartStore:
+    """Stand-in for S3PartStore under a local directory, for running the converter without S3."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def list_keys(self, prefix):
+        folder = os.path.join(self.directory, prefix)
+        if os.path.isdir(folder):
+            for name in os.listdir(folder):
+                yield prefix + name
+
+    def read(self, key):
+        with open(os.path.join(self.directory, key), 'rb') as f:
+            return f.read()
+
+    def write(self, key, data):
+        path = os.path.join(self.directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.partial', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.partial', path)
+
+    def exists(self, key):
+        return os.path.exists(os.path.join(self.directory, key))
+
+    def delete(self, keys):
+        for key in keys:
+            os.remove(os.path.join(self.directory, key))
+
+# --- Checkpoints ---
+
+class ExtractionCheckpoint:
+    """
+    The extracted rows of a document saved in page ranges as CSV parts under
+    checkpoints/{statementType}/{userId}/{name}/{contentHash}/, so a later attempt at
+    the same upload continues after the last saved page instead of page 1. Parts
+    are only trusted as a contiguous run from page 1. Fan-out workers save their
+    page ranges here too, and the merge reads them back the same way.
+    """
+
+    def __init__(self, store, output_key, digest):
+        self.store = store
+        name = output_key[len('processed/'):] if output_key.startswith('processed/') else output_key
+        self.prefix = f"{CHECKPOINT_PREFIX}/{os.path.splitext(name)[0]}/{digest}/"
+        self.parts = [] # (start, stop, key) in page order
+
+    def part_key(self, start, stop):
+        return f"{self.prefix}{start:05d}-{stop:05d}.csvpart"
+
+    def load(self):
+        """Reads which page ranges earlier attempts saved. Returns the number of pages done."""
+        found = {}
+        for key in self.store.list_keys(self.prefix):
+            match = PART_PATTERN.search(key)
+            if match:
+                found[int(match.group(1))] = (int(match.group(1)), int(match.group(2)), key)
+        self.parts = []
+        while self.pages_done in found:
+            self.parts.append(found[self.pages_done])
+        return self.pages_done
+
+    @property
+    def pages_done(self):
+        return self.parts[-1][1] if self.parts else 0
+
+    def has_part(self, start, stop):
+        return self.store.exists(self.part_key(start, stop))
+
+    def iter_saved_rows(self):
+        """Yields the rows of the saved pages, in page order."""
+        for _, _, key in self.parts:
+            yield from csv.reader(io.StringIO(self.store.read(key).decode('utf-8'), newline=''))
+
+    def save(self, start, stop, rows):
+        """Saves the rows of pages [start, stop)."""
+        buffer = io.StringIO(newline='')
+        csv.writer(buffer).writerows(rows)
+        key = self.part_key(start, stop)
+        self.store.write(key, buffer.getvalue().encode('utf-8'))
+        self.parts.append((start, stop, key))
+        print(f"Checkpointed pages {start + 1}-{stop} to {key}")
+
+    def clear(self):
+        """Deletes the saved parts once the CSV is published."""
+        if self.parts:
+            self.store.delete([key for _, _, key in self.parts])
+        self.parts = []
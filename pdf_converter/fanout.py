@@ -0,0 +1,139 @@
+import json
+import uuid
+from collections import deque
+from datetime import datetime, timedelta
+
+# --- Configuration ---
+RANGE_TASK = 'extract-range' # The task field of a page-range message; S3 event messages have none
+JOB_TTL_DAYS = 7 # Finished and abandoned jobs expire from the job table
+
+# --- Task Queues ---
+
+class SqsTaskQueue:
+    """Sends messages to the converter's SQS queue."""
+
+    def __init__(self, sqs_client, queue_url):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+
+    def send(self, body):
+        self.sqs_client.send_message(QueueUrl=self.queue_url, MessageBody=body)
+
+    def send_all(self, bodies):
+        """Sends in batches of ten, SQS's limit per request."""
+        for offset in range(0, len(bodies), 10):
+            entries = [{'Id': str(index), 'MessageBody': body} for index, body in enumerate(bodies[offset:offset + 10])]
+            response = self.sqs_client.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            if response.get('Failed'):
+                raise RuntimeError(f"Could not enqueue {len(response['Failed'])} tasks: {response['Failed'][0].get('Message')}")
+
+
+class LocalTaskQueue:
+    """
+    Stand-in for SqsTaskQueue that keeps messages in memory, so a split conversion
+    can run end to end offline. run() delivers them to the handler one at a time;
+    messages the handler reports as failed are retried up to max_receives times
+    and then kept in dead_letters.
+    """
+
+    def __init__(self, max_receives=3):
+        self.messages = deque()
+        self.max_receives = max_receives
+        self.dead_letters = []
+
+    def send(self, body):
+        self.messages.append((body, 0))
+
+    def send_all(self, bodies):
+        for body in bodies:
+            self.send(body)
+
+    def run(self, handler):
+        """Calls handler(event, context) for each queued message until the queue is empty."""
+        while self.messages:
+            body, receives = self.messages.popleft()
+            message_id = uuid.uuid4().hex
+            response = handler({'Records': [{'messageId': message_id, 'body': body}]}, None)
+            if any(f['itemIdentifier'] == message_id for f in response.get('batchItemFailures', [])):
+                if receives + 1 >= self.max_receives:
+                    self.dead_letters.append(body)
+                else:
+                    self.messages.append((body, receives + 1))
+
+# --- Completion Counter ---
+#
+# One item per split conversion: jobId, partCount, the set of finished part
+# indexes (partsDone) and mergedAt once the CSV is published. Adding to a set
+# instead of incrementing a number keeps re-delivered parts from being counted twice.
+
+class DynamoDBJobTracker:
+    """Split-conversion jobs in a DynamoDB table keyed by jobId, with expiresAt as its TTL attribute."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def start(self, job_id, part_count):
+        self.table.put_item(Item={
+            'jobId': job_id,
+            'partCount': part_count,
+            'createdAt': datetime.utcnow().isoformat(),
+            'expiresAt': int((datetime.utcnow() + timedelta(days=JOB_TTL_DAYS)).timestamp()),
+        })
+
+    def get(self, job_id):
+        return self.table.get_item(Key={'jobId': job_id}, ConsistentRead=True).get('Item')
+
+    def complete_part(self, job_id, part):
+        """Records a finished part. Returns the job's state after the update."""
+        response = self.table.update_item(
+            Key={'jobId': job_id},
+            UpdateExpression='ADD #parts_done :part',
+            ConditionExpression='attribute_exists(#job_id)',
+            ExpressionAttributeNames={'#parts_done': 'partsDone', '#job_id': 'jobId'},
+            ExpressionAttributeValues={':part': {part}},
+            ReturnValues='ALL_NEW'
+        )
+        return response['Attributes']
+
+    def mark_merged(self, job_id):
+        self.table.update_item(
+            Key={'jobId': job_id},
+            UpdateExpression='SET #merged_at = :now',
+            ExpressionAttributeNames={'#merged_at': 'mergedAt'},
+            ExpressionAttributeValues={':now': datetime.utcnow().isoformat()}
+        )
+
+
+class InMemoryJobTracker:
+    """Stand-in for DynamoDBJobTracker that keeps jobs in a dict, for tests and local runs."""
+
+    def __init__(self):
+        self.jobs = {}
+
+    def start(self, job_id, part_count):
+        self.jobs[job_id] = {'jobId': job_id, 'partCount': part_count, 'createdAt': datetime.utcnow().isoformat()}
+
+    def get(self, job_id):
+        job = self.jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+    def complete_part(self, job_id, part):
+        job = self.jobs[job_id]
+        job.setdefault('partsDone', set()).add(part)
+        return dict(job)
+
+    def mark_merged(self, job_id):
+        self.jobs[job_id]['mergedAt'] = datetime.utcnow().isoformat()
+
+# --- Planning ---
+
+def plan_ranges(start, stop, pages_per_task):
+    """Splits pages [start, stop) into consecutive ranges of at most pages_per_task pages."""
+    return [(page, min(page + pages_per_task, stop)) for page in range(start, stop, pages_per_task)]
+
+def range_task_body(job, part, start, stop):
+    """The message for one page range. job holds what every task of the job shares."""
+    return json.dumps(dict(job, task=RANGE_TASK, part=part, start=start, stop=stop))
+
+def job_complete(job):
+    return len(job.get('partsDone', ())) >= job['partCount']
@@ -0,0 +1,79 @@
+"""
+Benchmarks the layout templates against generic table detection.
+
+Every page of each PDF is extracted both ways: with find_tables(), as the
+converter does when no template matches, and with the layout templates for the
+statement type. For each file it reports how many pages a template took, on how
+many of those both paths produced the same rows (ignoring whitespace), and the
+time each path spent.
+
+    python pdf_converter/layout_benchmark.py --statement-type bank-statement statements/*.pdf
+"""
+import argparse
+import time
+
+import fitz  # PyMuPDF library
+
+from layouts import LayoutExtractor
+
+
+def normalize(rows):
+    """Row cells with empty cells as '' and all whitespace collapsed to single spaces."""
+    return [[' '.join((value or '').split()) for value in row] for row in rows]
+
+def benchmark_file(path, statement_type):
+    doc = fitz.open(path)
+    extractor = LayoutExtractor(statement_type)
+    result = {
+        'file': path,
+        'pages': doc.page_count,
+        'templatePages': 0,
+        'matchingPages': 0,
+        'mismatchedPages': [],
+        'genericSeconds': 0.0,
+        'templateSeconds': 0.0,
+    }
+    for page_num in range(doc.page_count):
+        page = doc[page_num]
+
+        start = time.perf_counter()
+        generic_rows = [row for table in page.find_tables().tables for row in table.extract()]
+        result['genericSeconds'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        template_rows = extractor.extract(page)
+        result['templateSeconds'] += time.perf_counter() - start
+
+        if template_rows is None:
+            continue
+        result['templatePages'] += 1
+        if normalize(template_rows) == normalize(generic_rows):
+            result['matchingPages'] += 1
+        else:
+            result['mismatchedPages'].append(page_num + 1)
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare layout-template extraction with find_tables().")
+    parser.add_argument('paths', nargs='+', help="Statement PDFs to extract")
+    parser.add_argument('--statement-type', required=True, help="Statement type key segment, e.g. bank-statement")
+    args = parser.parse_args(argv)
+
+    generic_total = template_total = 0.0
+    for path in args.paths:
+        result = benchmark_file(path, args.statement_type)
+        generic_total += result['genericSeconds']
+        template_total += result['templateSeconds']
+        print(f"{path}: template on {result['templatePages']}/{result['pages']} pages, "
+              f"same rows on {result['matchingPages']}; "
+              f"generic {result['genericSeconds']:.3f}s, template {result['templateSeconds']:.3f}s")
+        if result['mismatchedPages']:
+            print(f"  rows differ on pages {result['mismatchedPages']}")
+
+    if template_total:
+        print(f"Total: generic {generic_total:.3f}s, template {template_total:.3f}s "
+              f"({generic_total / template_total:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+import re
+from bisect import bisect_right
+
+import numpy as np
+
+# --- Configuration ---
+LINE_TOLERANCE = 3.0 # Points two words' vertical centres may differ by and still share a line
+ROW_SPAN = 1.5 # Line heights from a row's date line within which other lines belong to the row
+MIN_CONFIDENCE = 0.9 # Share of candidate rows that must look like transactions
+TABLE_GAP = 4.0 # Line heights of empty space that end a table (e.g. before a page footer)
+DATE_PATTERN = re.compile(r'^\d{1,4}[-/. ]([A-Za-z]{3,9}|\d{1,2})[-/. ,]+\d{2,4}')
+AMOUNT_PATTERN = re.compile(r'^[-+]?\(?[-+]?(\d{1,3}(,\d{3})+|\d+)?(\.\d+)?\)?( ?(CR|DR))?$', re.IGNORECASE)
+
+# --- Templates ---
+
+class LayoutTemplate:
+    """
+    A provider's fixed statement layout: the column header labels in left-to-right
+    order, the column that starts every transaction row (a date), and the columns
+    that must hold amounts. Column x-boundaries are placed from where the header
+    labels sit on the page, so the template survives small shifts between
+    statement generations while a changed column set simply stops matching.
+    """
+
+    def __init__(self, name, statement_types, columns, date_column, amount_columns):
+        self.name = name
+        self.statement_types = statement_types
+        self.columns = columns
+        self.labels = [column.upper().split() for column in columns]
+        self.date_index = columns.index(date_column)
+        self.amount_indexes = [columns.index(column) for column in amount_columns]
+
+    def applies_to(self, statement_type):
+        return any(kind in statement_type for kind in self.statement_types)
+
+
+LAYOUT_TEMPLATES = [
+    LayoutTemplate(
+        name='mtn-momo',
+        statement_types=['momo-mtn-statement'],
+        columns=['TRANSACTION DATE', 'FROM ACCT', 'FROM NAME', 'FROM NO.', 'TRANS. TYPE', 'AMOUNT', 'FEES',
+                 'E-LEVY', 'BAL BEFORE', 'BAL AFTER', 'TO NO.', 'TO NAME', 'TO ACCT', 'F_ID', 'REF', 'OVA'],
+        date_column='TRANSACTION DATE',
+        amount_columns=['AMOUNT', 'FEES', 'E-LEVY', 'BAL BEFORE', 'BAL AFTER'],
+    ),
+    LayoutTemplate(
+        name='bank-trans-value-date',
+        statement_types=['bank'],
+        columns=['Trans Date', 'Value Date', 'Description', 'Debit', 'Credit', 'Balance'],
+        date_column='Trans Date',
+        amount_columns=['Debit', 'Credit', 'Balance'],
+    ),
+    LayoutTemplate(
+        name='bank-posting-date',
+        statement_types=['bank'],
+        columns=['Date', 'Description', 'Debit', 'Credit', 'Balance'],
+        date_column='Date',
+        amount_columns=['Debit', 'Credit', 'Balance'],
+    ),
+]
+
+# --- Word Lines ---
+
+class WordLine:
+    """Words sharing a baseline, left to right. Each word is (x0, y0, x1, y1, text)."""
+
+    def __init__(self, word):
+        self.words = [word]
+        self.top, self.bottom = word[1], word[3]
+
+    @property
+    def middle(self):
+        return (self.top + self.bottom) / 2
+
+    def add(self, word):
+        self.words.append(word)
+        self.top = min(self.top, word[1])
+        self.bottom = max(self.bottom, word[3])
+
+
+def group_lines(words):
+    """Groups page.get_text("words") output into lines, top to bottom."""
+    lines = []
+    for word in sorted(words, key=lambda w: ((w[1] + w[3]) / 2, w[0])):
+        word = word[:5]
+        if lines and (word[1] + word[3]) / 2 - lines[-1].middle <= LINE_TOLERANCE:
+            lines[-1].add(word)
+        else:
+            lines.append(WordLine(word))
+    for line in lines:
+        line.words.sort()
+    return lines
+
+# --- Matching ---
+
+class LayoutMatch:
+    """A template located on a page: the x-extent of each header label and the header cells."""
+
+    def __init__(self, template, spans, header):
+        self.template = template
+        self.spans = spans
+        self.header = header
+
+    def to_dict(self):
+        """A JSON-serializable form, for handing the match to workers in other invocations."""
+        return {'template': self.template.name, 'spans': [list(span) for span in self.spans], 'header': self.header}
+
+    @classmethod
+    def from_dict(cls, data):
+        template = next(t for t in LAYOUT_TEMPLATES if t.name == data['template'])
+        return cls(template, [tuple(span) for span in data['spans']], data['header'])
+
+
+def match_header(template, line):
+    """Returns a LayoutMatch when the line consists of exactly the template's labels in order, else None."""
+    texts = [word[4].upper() for word in line.words]
+    spans, header = [], []
+    position = 0
+    for label in template.labels:
+        if texts[position:position + len(label)] != label:
+            return None
+        label_words = line.words[position:position + len(label)]
+        spans.append((label_words[0][0], label_words[-1][2]))
+        header.append(' '.join(word[4] for word in label_words))
+        position += len(label)
+    if position != len(texts):
+        return None
+    return LayoutMatch(template, spans, header)
+
+
+def column_boundaries(spans, lines):
+    """
+    Places the boundary between each pair of neighbouring header labels in the gap
+    between them where the fewest of the page's words cross, preferring the widest
+    such stretch. Descriptions often run well past their header and amounts are
+    often right-aligned, so the whitespace between columns is a safer cut than the
+    midpoint between the labels.
+    """
+    starts = np.sort(np.array([word[0] for line in lines for word in line.words]))
+    ends = np.sort(np.array([word[2] for line in lines for word in line.words]))
+    boundaries = []
+    for (_, gap_start), (gap_end, _) in zip(spans, spans[1:]):
+        inside = np.concatenate((starts, ends))
+        inside = inside[(inside > gap_start) & (inside < gap_end)]
+        edges = np.unique(np.concatenate(([gap_start, gap_end], inside)))
+        if len(edges) < 2:
+            boundaries.append((gap_start + gap_end) / 2)
+            continue
+        middles = (edges[:-1] + edges[1:]) / 2
+        # Words starting before a point minus words ending before it = words crossing it
+        crossing = np.searchsorted(starts, middles) - np.searchsorted(ends, middles)
+        widths = np.diff(edges)
+        best = np.lexsort((-widths, crossing))[0]
+        boundaries.append(float(middles[best]))
+    return boundaries
+
+
+def bucket_line(boundaries, column_count, line):
+    """Splits a line's words into columns by their horizontal centre."""
+    cells = [[] for _ in range(column_count)]
+    for x0, _, x1, _, text in line.words:
+        cells[bisect_right(boundaries, (x0 + x1) / 2)].append(text)
+    return [' '.join(cell) for cell in cells]
+
+
+def is_transaction_row(template, row):
+    if not DATE_PATTERN.match(row[template.date_index]):
+        return False
+    return all(not row[i] or AMOUNT_PATTERN.match(row[i].replace(' ', '')) for i in template.amount_indexes)
+
+# --- Extraction ---
+
+class LayoutExtractor:
+    """
+    Extracts table rows from a page's words with the first template whose header
+    is found on it. The last match is kept, so pages that continue the table
+    without repeating the header reuse its label positions. Returns None whenever the
+    result is not confidently a transaction table; the caller then falls back to
+    generic table detection.
+    """
+
+    def __init__(self, statement_type, match=None):
+        self.templates = [template for template in LAYOUT_TEMPLATES if template.applies_to(statement_type)]
+        self.match = match
+
+    def extract(self, page):
+        if not self.templates:
+            return None
+        lines = group_lines(page.get_text("words"))
+
+        match, body = None, lines
+        for index, line in enumerate(lines):
+            match = next((m for m in (match_header(t, line) for t in self.templates) if m), None)
+            if match:
+                body = lines[index + 1:]
+                break
+        rows = self.extract_rows(match or self.match, body)
+        if rows is None:
+            return None
+        if match:
+            self.match = match
+            rows.insert(0, list(match.header))
+        return rows
+
+    def extract_rows(self, match, lines):
+        """
+        Buckets the lines into rows. A row starts at each line with text in the date
+        column; wrapped cells can sit above that line as well as below it (cells are
+        often vertically centred), so every other line joins the row whose date line
+        is nearest, and its text is appended with newlines as find_tables does.
+        Lines too far from any date line become rows of their own. Every row is
+        returned in page order, transactions or not (opening and closing balances,
+        subtotals), as find_tables keeps them; only the confidence check looks at
+        which rows are transactions. Rows beyond a TABLE_GAP of empty space before
+        the first or after the last transaction (page titles, footers) lie outside
+        the table and are left out, as find_tables leaves them out.
+        """
+        if match is None or not lines:
+            return None
+        template = match.template
+        boundaries = column_boundaries(match.spans, lines)
+        cells = [bucket_line(boundaries, len(template.columns), line) for line in lines]
+        anchors = [index for index, row in enumerate(cells) if row[template.date_index]]
+        if not anchors:
+            return None
+
+        members = {anchor: [anchor] for anchor in anchors}
+        for index, line in enumerate(lines):
+            if cells[index][template.date_index]:
+                continue
+            position = bisect_right(anchors, index)
+            # On a tie the row above wins, as for an ordinary wrapped line
+            nearest = min(anchors[max(position - 1, 0):position + 1], key=lambda a: abs(lines[a].middle - line.middle))
+            if abs(lines[nearest].middle - line.middle) <= ROW_SPAN * (line.bottom - line.top):
+                members[nearest].append(index)
+            else:
+                members[index] = [index]
+
+        # Ordered by each row's first line, so stray lines keep their place between transactions
+        row_lines = sorted(sorted(indexes) for indexes in members.values())
+        rows = [
+            ['\n'.join(part for part in column if part) for column in zip(*(cells[i] for i in indexes))]
+            for indexes in row_lines
+        ]
+        valid = [index for index, row in enumerate(rows) if is_transaction_row(template, row)]
+        if not valid:
+            return None
+
+        # Blocks of lines separated by a TABLE_GAP; the table spans the blocks holding transactions
+        block = [0]
+        for previous, line in zip(lines, lines[1:]):
+            block.append(block[-1] + (line.top - previous.bottom > TABLE_GAP * (line.bottom - line.top)))
+        first_block, last_block = block[row_lines[valid[0]][0]], block[row_lines[valid[-1]][-1]]
+        rows = [row for row, indexes in zip(rows, row_lines) if first_block <= block[indexes[0]] <= last_block]
+        if len(valid) < MIN_CONFIDENCE * len(rows):
+            return None
+        return rows
@@ -0,0 +1,144 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# --- Configuration ---
+PART_SIZE = 5 * 1024 * 1024 # S3's minimum size for every part but the last
+MAX_PENDING_PARTS = 2 # Parts uploading in the background before write() waits; bounds buffered memory
+
+
+class S3MultipartUpload:
+    """
+    A write-only stream into an S3 object. Written text or bytes are buffered and
+    sent as multipart parts of part_size on a background thread, so the caller keeps
+    producing data while earlier parts upload. At most max_pending parts are held
+    at once. Output that never fills a part is sent with a single put_object on
+    close(), so small files cost one request. Nothing is visible in S3 until
+    close(); abort() (or leaving a with block with an exception) discards the upload.
+    """
+
+    def __init__(self, s3_client, bucket, key, content_type, metadata=None,
+                 part_size=PART_SIZE, max_pending=MAX_PENDING_PARTS):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.metadata = metadata or {}
+        self.part_size = part_size
+        self.max_pending = max_pending
+        self.buffer = bytearray()
+        self.bytes_written = 0
+        self.upload_id = None
+        self.parts = [] # Futures of {'PartNumber', 'ETag'}, in part order
+        self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.buffer += data
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self._send_part(part)
+        return len(data)
+
+    def _send_part(self, body):
+        if self.upload_id is None:
+            response = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, ContentType=self.content_type, Metadata=self.metadata
+            )
+            self.upload_id = response['UploadId']
+            self.executor = ThreadPoolExecutor(max_workers=self.max_pending)
+
+        # Wait for the oldest part still in flight before buffering another
+        in_flight = [future for future in self.parts if not future.done()]
+        if len(in_flight) >= self.max_pending:
+            in_flight[0].result()
+        self.parts.append(self.executor.submit(self._upload_part, len(self.parts) + 1, body))
+
+    def _upload_part(self, part_number, body):
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=body
+        )
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def close(self):
+        """Publishes the object."""
+        if self.upload_id is None:
+            self.s3_client.put_object(
+                Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer),
+                ContentType=self.content_type, Metadata=self.metadata
+            )
+            self.buffer = bytearray()
+            return
+        try:
+            if self.buffer:
+                self._send_part(bytes(self.buffer))
+                self.buffer = bytearray()
+            parts = [future.result() for future in self.parts]
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': parts}
+            )
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.executor.shutdown()
+
+    def abort(self):
+        """Discards the upload so no parts are left behind (and billed)."""
+        self.buffer = bytearray()
+        if self.upload_id is None:
+            return
+        self.executor.shutdown(cancel_futures=True)
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            print(f"Warning: could not abort multipart upload of {self.key}: {e}")
+        self.upload_id = None
+
+
+class LocalUpload:
+    """
+    Stand-in for S3MultipartUpload that writes under a local directory, for running
+    the converter without S3. The file appears under its final name on close().
+    """
+
+    def __init__(self, directory, key, content_type=None, metadata=None):
+        self.path = os.path.join(directory, key)
+        self.metadata = metadata or {}
+        self.bytes_written = 0
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path + '.partial', 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.bytes_written += len(data)
+        return self.file.write(data)
+
+    def close(self):
+        self.file.close()
+        os.replace(self.path + '.partial', self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.path + '.partial')
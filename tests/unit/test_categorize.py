@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(ROOT, 'dependencies', 'statement_common', 'python'))
+
+from statements.categorize import CATEGORY_IDS, UNCATEGORIZED, build_keyword_automaton, categorize  # noqa: E402
+
+
+@pytest.mark.parametrize('description', ['POS SALE SHOPRITE', 'GIFT SHOP', 'SHIFT ALLOWANCE', 'REVENUE SHARE', 'COMMUNITY DUES', 'VATICAN TOURS'])
+def test_short_keywords_do_not_match_inside_words(description):
+    assert categorize(description, True) == UNCATEGORIZED
+    assert categorize(description, False) == UNCATEGORIZED
+
+
+@pytest.mark.parametrize('description, is_inflow, category', [
+    ('SAL/JAN 2024', True, 'salary'),
+    ('FT 0123 GCB', False, 'transfer'),
+    ('REV-POS 8812', True, 'reversal'),
+    ('COMM ON TRANSFER', False, 'fees'),
+    ('VAT ON SMS', False, 'fees'),
+])
+def test_short_keywords_match_as_whole_words(description, is_inflow, category):
+    assert categorize(description, is_inflow) == CATEGORY_IDS[category]
+
+
+def test_short_prefix_keywords_are_rejected():
+    with pytest.raises(ValueError):
+        build_keyword_automaton({'transfer': ['TRF*']})
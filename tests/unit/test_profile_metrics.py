@@ -0,0 +1,114 @@
+import copy
+import os
+import re
+import sys
+
+import pytest
+from botocore.exceptions import ClientError
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(ROOT, 'dependencies', 'statement_common', 'python'))
+sys.path.insert(0, os.path.join(ROOT, 'metric_analyzer'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import app as analyzer  # noqa: E402
+
+
+class FakeProfileTable:
+    """The subset of DynamoDB's GetItem and UpdateItem the analyzer uses on the profile table."""
+
+    def __init__(self, item=None):
+        self.item = item
+
+    @staticmethod
+    def resolve(expression, names):
+        return [names.get(part, part) for part in expression.strip().split('.')]
+
+    @staticmethod
+    def lookup(item, path):
+        for key in path:
+            if not isinstance(item, dict) or key not in item:
+                return None
+            item = item[key]
+        return item
+
+    def get_item(self, Key, ProjectionExpression, ExpressionAttributeNames, **kwargs):
+        if self.item is None:
+            return {}
+        projected = {}
+        for expression in ProjectionExpression.split(','):
+            path = self.resolve(expression, ExpressionAttributeNames)
+            value = self.lookup(self.item, path)
+            if value is None:
+                continue
+            target = projected
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = copy.deepcopy(value)
+        return {'Item': projected}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues, ConditionExpression=None):
+        item = copy.deepcopy(self.item) if self.item is not None else dict(Key)
+        if ConditionExpression:
+            match = re.fullmatch(r'attribute_not_exists\((.+)\)|(.+) = (:\w+)', ConditionExpression)
+            if match.group(1):
+                holds = self.lookup(item, self.resolve(match.group(1), ExpressionAttributeNames)) is None
+            else:
+                holds = self.lookup(item, self.resolve(match.group(2), ExpressionAttributeNames)) == ExpressionAttributeValues[match.group(3)]
+            if not holds:
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+
+        assert UpdateExpression.startswith('SET ')
+        for assignment in re.split(r',\s*(?![^()]*\))', UpdateExpression[len('SET '):]):
+            target, source = (part.strip() for part in assignment.split('=', 1))
+            path = self.resolve(target, ExpressionAttributeNames)
+            match = re.fullmatch(r'if_not_exists\((.+), (:\w+)\)', source)
+            if match:
+                current = self.lookup(item, self.resolve(match.group(1), ExpressionAttributeNames))
+                value = current if current is not None else ExpressionAttributeValues[match.group(2)]
+            else:
+                value = ExpressionAttributeValues[source]
+            parent = self.lookup(item, path[:-1]) if len(path) > 1 else item
+            if not isinstance(parent, dict):
+                raise ClientError({'Error': {'Code': 'ValidationException'}}, 'UpdateItem')
+            parent[path[-1]] = copy.deepcopy(value)
+        self.item = item
+        return {}
+
+
+def metric_item(statement_id, statement_type, period_end):
+    return {
+        'id': statement_id,
+        'statementType': statement_type,
+        'analysisDate': f'{period_end}T00:00:00',
+        'periodEnd': period_end,
+    }
+
+
+@pytest.fixture
+def profile_table(monkeypatch):
+    table = FakeProfileTable()
+    monkeypatch.setattr(analyzer, 'get_profile_table', lambda: table)
+    return table
+
+
+def test_second_statement_type_keeps_first_types_ledger_metrics(profile_table):
+    analyzer.save_profile_metrics(
+        'u1', [metric_item('bank.csv', 'bank-statement', '2024-05-31')],
+        {'bank-statement': {'version': 1, 'windows': {}}}
+    )
+    analyzer.save_profile_metrics(
+        'u1', [metric_item('momo.csv', 'mtn-momo', '2024-06-30')],
+        {'mtn-momo': {'version': 1, 'windows': {}}}
+    )
+
+    ledger_metrics = profile_table.item['ledgerMetrics']
+    assert ledger_metrics['bank-statement'] == {'version': 1, 'windows': {}}
+    assert ledger_metrics['mtn-momo'] == {'version': 1, 'windows': {}}
+
+
+def test_older_ledger_metrics_are_not_written(profile_table):
+    analyzer.save_profile_metrics('u1', [metric_item('a.csv', 'bank-statement', '2024-05-31')], {'bank-statement': {'version': 3}})
+    analyzer.save_profile_metrics('u1', [metric_item('b.csv', 'bank-statement', '2024-06-30')], {'bank-statement': {'version': 2}})
+
+    assert profile_table.item['ledgerMetrics']['bank-statement'] == {'version': 3}